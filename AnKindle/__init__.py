@@ -7,9 +7,10 @@ from aqt import QAction, QMenu, isWin, os
 from aqt import mw
 from aqt.importing import importFile
 from aqt.utils import showText
-from .const import MUST_IMPLEMENT_FIELDS, DEFAULT_TEMPLATE, __version__
+from .const import MUST_IMPLEMENT_FIELDS, DEFAULT_TEMPLATE, __version__, WARMUP_STOP_WAIT_MS
 from .gui import Window
 from .lang import _trans
+from .warmup import start_index_warmup
 
 
 def _debug_step(*args):
@@ -62,6 +63,7 @@ class AnKindleAddon:
         self.action_show_vocab_dialog = None
         self.action_show_clipping_dialog = None
         # self.main_menu_action = None
+        self.index_warmup = None
 
         if not self.avl_col_model_names:
             importFile(mw, DEFAULT_TEMPLATE)
@@ -74,10 +76,24 @@ class AnKindleAddon:
     def perform_hooks(self, func):
         # func('reviewCleanup', self.on_review_cleanup)
         func('profileLoaded', self.on_profile_loaded)
+        func('unloadProfile', self.on_profile_unload)
         # func('afterStateChange', self.after_anki_state_change)
 
     def on_profile_loaded(self):
         self.init_menu()
+        if not self.index_warmup:
+            self.index_warmup = start_index_warmup(mw)
+
+    def on_profile_unload(self):
+        if self.index_warmup:
+            self.index_warmup.cancel()
+            # a cancelled build stops at its next index row, the wait is bounded in case it is stuck in a
+            # single long step (key block parsing, sqlite index creation). The thread is owned by mw and
+            # finishes on its own then.
+            self.index_warmup.wait(WARMUP_STOP_WAIT_MS)
+            # a dictionary loaded after this by a warm-up still running is closed right away
+            self.index_warmup.release()
+            self.index_warmup = None
 
     def on_start(self):
         if self.ext_available:
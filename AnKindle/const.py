@@ -9,6 +9,11 @@ __version__ = "0.7.31"
 HAS_SET_UP = False
 ADDON_CD = 1016931132
 DEBUG = False
+IMPORT_BATCH_SIZE = 100  # words per batch of the import pipeline
+MDX_COMPACT_INDEX = False  # also build the compact .mdx.idx next to the .mdx.db, costs disk and build time for no faster lookups
+MDX_CHECK_BLOCKS = False  # decompress and verify every record block while building an MDX/MDD index
+MDX_CHECK_WORKERS = 0  # threads verifying the record blocks, 0 for one per CPU core
+WARMUP_STOP_WAIT_MS = 3000  # longest wait of the profile unload for the index warm-up to stop
 ONLINE_DOC_URL = "https://github.com/upday7/AnKindle/blob/master/docs/DOC.md"
 DEFAULT_TEMPLATE = six.ensure_text(os.path.join(os.path.dirname(__file__), u"resource", u"AnKindle.apkg"))
 CLIPPINGS_DEFAULT_TEMPLATE_NAME = u"AnKindleClipping-Default"
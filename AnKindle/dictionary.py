@@ -0,0 +1,825 @@
+# -*- coding: utf-8 -*-
+# Created: 10/18/2026
+# Project : AnKindle
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import traceback
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+from .const import MDX_CHECK_BLOCKS, MDX_CHECK_WORKERS, MDX_COMPACT_INDEX
+from .libs import StardictBuilder
+from .libs import six
+from .libs.mdict import mdict_query
+from .libs.mdict import readmdict
+
+LINK_PREFIX = u"@@@LINK="
+# redirects followed per word before giving up, guards against cyclic links
+MAX_LINK_DEPTH = 5
+# css / js files next to the MDX, copied to the media folder along with the definitions
+INCLUDE_MDX_EXTRAS = ['.CSS', '.JS']
+
+# media folder writes may come from several import workers
+_ASSET_LOCK = threading.Lock()
+
+# mdx file -> lock held while its indexes are checked or built, see build_lock
+_BUILD_LOCKS = {}
+_BUILD_LOCKS_LOCK = threading.Lock()
+
+# .ifo file -> [fingerprint, loaded StardictBuilder, lock of its lookups, number of open backends], a StarDict
+# dictionary is loaded once and shared by the backends open at the same time. It is closed with the last one, its
+# files stay mapped meanwhile and cannot be replaced on Windows. The warm-up holds a backend until the profile is
+# unloaded, so the imports of a session reuse the loaded dictionary
+_STARDICTS = {}
+
+# a definition as already adapted to Anki by OpenedDict.render, what DefinitionCache keeps between imports
+CachedDefinition = namedtuple("CachedDefinition", ["html", "media_files", "css_files"])
+
+
+# every media reference of a definition is found by a single scan with this pattern, see rewrite_media_paths
+_MEDIA_REF_RE = re.compile(
+    r'(?P<sound_link><a[^>]+?href="sound:(?P<sound>[^"]*?\.(?:mp3|wav))"[^>]*?>(?P<label>.*?)</a>)'
+    r'|(?P<img><img\b[^>]*>)'
+    r'|(?P<attr>href|src)="(?P<value>[^"]*)"'
+)
+_IMG_SRC_RE = re.compile(r'src="([^"]*)"')
+_IMG_PATH_RE = re.compile(r'[\w\./]\S+\Z', re.U)
+_JS_PATH_RE = re.compile(r'[\w\./]\S+?\.js\Z', re.U)
+_CSS_PATH_RE = re.compile(r'\S+?\.css\Z')
+_SOUND_PATH_RE = re.compile(r'sound:(.*?\.(?:mp3|wav))\Z')
+
+
+def _media_name(path):
+    return u'_' + path.split('/')[-1]
+
+
+def build_lock(mdx_file):
+    """
+    lock of the indexes of a dictionary, an import waits for the background warm-up building them
+    instead of building them a second time
+    """
+    key = os.path.normcase(os.path.abspath(mdx_file))
+    with _BUILD_LOCKS_LOCK:
+        return _BUILD_LOCKS.setdefault(key, threading.Lock())
+
+
+def open_index(mdx_file, cancel=None, check=False, check_workers=None):
+    """
+    IndexBuilder of the dictionary with up to date .mdx.db / .mdd.db, built first if needed
+
+    :param cancel: threading.Event stopping the build, see mdict_query.BuildCancelled
+    :param check: verify the record blocks of the files rebuilt, on check_workers threads. The figures are left
+        in the check_stats of the builder
+    """
+    builder = mdict_query.IndexBuilder(mdx_file, check=check, check_workers=check_workers,
+                                       compact_index=MDX_COMPACT_INDEX, cancel=cancel)
+    with build_lock(mdx_file):
+        builder.get_header()
+        builder.check_build()
+    return builder
+
+
+def check_summary(check_stats):
+    """
+    throughput of the record blocks verified by index builds, from {.mdx / .mdd file: check_stats}
+    """
+    blocks = sum(stats['blocks'] for stats in check_stats.values())
+    mb = sum(stats['bytes'] for stats in check_stats.values()) / 1048576.0
+    seconds = sum(stats['seconds'] for stats in check_stats.values())
+    return "{} record blocks ({:.1f} MB) checked at {:.1f} MB/s".format(blocks, mb, mb / max(seconds, 1e-6))
+
+
+def _escape_html(text):
+    return text.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(u'>', u'&gt;')
+
+
+class MdxBackend(object):
+    """
+    MDX dictionary, looked up through the indexes of IndexBuilder, media files come from its MDD
+    """
+
+    def __init__(self, dict_file):
+        self.dict_file = dict_file
+        self.builder = None
+
+    def open(self, cancel=None):
+        builder = open_index(self.dict_file, cancel, MDX_CHECK_BLOCKS, MDX_CHECK_WORKERS)
+        try:
+            builder._encoding = readmdict.MDX(self.dict_file, only_header=True)._encoding
+        except Exception:
+            builder.close()
+            raise
+        self.builder = builder
+        return self
+
+    def fingerprint(self):
+        return mdict_query.file_fingerprint(self.dict_file)
+
+    @property
+    def media(self):
+        """
+        source of the media files, see save_media_files
+        """
+        return self.builder
+
+    def lookup_many(self, words):
+        """
+        :return: {word: [record, ]} for the words found
+        """
+        return self.builder.mdx_lookup_many(words)
+
+    @property
+    def block_cache_stats(self):
+        return self.builder.block_cache_stats
+
+    @property
+    def check_stats(self):
+        """
+        {.mdx / .mdd file: check_stats} of the record blocks verified while opening, see IndexBuilder.check_build
+        """
+        return self.builder.check_stats
+
+    @property
+    def errors(self):
+        """
+        (what failed, traceback) of the errors the dictionary recovered from
+        """
+        return self.builder.errors
+
+    def close(self):
+        if self.builder:
+            self.builder.close()
+
+
+class StardictResources(object):
+    """
+    res/ folder of a StarDict dictionary, looked up by save_media_files the same way as a MDD
+    """
+
+    def __init__(self, res_dir):
+        self.res_dir = res_dir
+        self._by_basename = None  # lower-cased file name -> [path relative to res_dir, ]
+        self._lock = threading.Lock()
+
+    def mdd_keys_by_basename(self, basenames):
+        with self._lock:
+            if self._by_basename is None:
+                self._by_basename = {}
+                for root, dirs, files in os.walk(self.res_dir):
+                    for f in files:
+                        path = os.path.relpath(os.path.join(root, f), self.res_dir)
+                        self._by_basename.setdefault(mdict_query.mdd_basename(path), []).append(path)
+        wanted = set(mdict_query.mdd_basename(b) for b in basenames)
+        return dict((b, self._by_basename[b]) for b in wanted if b in self._by_basename)
+
+    def mdd_lookup(self, path):
+        try:
+            with open(os.path.join(self.res_dir, path), 'rb') as f:
+                return [f.read()]
+        except (IOError, OSError):
+            return []
+
+
+class StardictBackend(object):
+    """
+    StarDict dictionary (.ifo / .idx / .dict / .syn), media files come from its res/ folder
+
+    The loaded dictionary is shared through _STARDICTS while backends of it are open.
+    """
+    # files of a StarDict dictionary next to the .ifo, part of its fingerprint
+    EXTENSIONS = ['.ifo', '.idx', '.idx.gz', '.dict', '.dict.dz', '.syn']
+    # sametypesequence of plain text definitions, escaped to html
+    TEXT_TYPES = ['m', 't', 'y', 'l']
+
+    def __init__(self, dict_file):
+        self.dict_file = dict_file
+        self.stardict = None
+        self.media = StardictResources(os.path.join(os.path.split(dict_file)[0], u"res"))
+        self._lock = None
+        self._fingerprint = None
+        self._key = os.path.normcase(os.path.abspath(dict_file))
+        self._loaded = None  # entry of _STARDICTS
+
+    def open(self, cancel=None):
+        # a StarDict index is loaded, not built, there is nothing worth cancelling
+        with build_lock(self.dict_file):
+            fingerprint = self.fingerprint()
+            loaded = _STARDICTS.get(self._key)
+            if loaded is None or loaded[0] != fingerprint:
+                stardict = StardictBuilder(self.dict_file)
+                try:
+                    stardict.get_header()
+                    stardict.check_build()
+                except Exception as e:
+                    stardict.close()
+                    # pystardict reports every malformed file with a bare Exception
+                    raise ValueError("{}: {}".format(self.dict_file, e))
+                # a replaced dictionary is released by its last backend, see close
+                loaded = _STARDICTS[self._key] = [fingerprint, stardict, threading.Lock(), 0]
+            loaded[3] += 1
+        self._loaded = loaded
+        self._fingerprint, self.stardict, self._lock = loaded[:3]
+        return self
+
+    def fingerprint(self):
+        if self._fingerprint is None:
+            prefix = os.path.splitext(self.dict_file)[0]
+            self._fingerprint = u"|".join(mdict_query.file_fingerprint(prefix + ext) for ext in self.EXTENSIONS
+                                          if os.path.isfile(prefix + ext))
+        return self._fingerprint
+
+    def _to_html(self, definition):
+        if self.stardict.ifo.sametypesequence in self.TEXT_TYPES:
+            return _escape_html(definition).replace(u'\n', u'<br>')
+        return definition
+
+    def lookup_many(self, words):
+        """
+        :return: {word: [definition, ]} for the words found
+        """
+        results = {}
+        # .dict reads share one file handle
+        with self._lock:
+            for word in words:
+                definition = self.stardict.get(word)
+                if definition:
+                    results[word] = [self._to_html(definition)]
+        return results
+
+    @property
+    def block_cache_stats(self):
+        return {'hits': 0, 'misses': 0}
+
+    @property
+    def check_stats(self):
+        return {}
+
+    @property
+    def errors(self):
+        return []
+
+    def close(self):
+        if not self._loaded:
+            return
+        loaded, self._loaded, self.stardict = self._loaded, None, None
+        with build_lock(self.dict_file):
+            loaded[3] -= 1
+            if loaded[3] > 0:
+                with self._lock:
+                    # definitions read during the import, the files stay open for the other backends
+                    loaded[1].clear()
+                return
+            if _STARDICTS.get(self._key) is loaded:
+                del _STARDICTS[self._key]
+        with self._lock:
+            loaded[1].close()
+
+
+# dictionary file extension -> backend
+DICT_BACKENDS = OrderedDict([
+    ('.mdx', MdxBackend),
+    ('.ifo', StardictBackend),
+])
+
+
+def open_backend(dict_file, cancel=None):
+    """
+    backend of the dictionary file with its indexes ready, built first if needed
+
+    :param cancel: threading.Event stopping an index build with mdict_query.BuildCancelled
+    :raise ValueError: no backend for the file extension
+    """
+    backend = DICT_BACKENDS.get(os.path.splitext(dict_file)[1].lower())
+    if backend is None:
+        raise ValueError("unsupported dictionary: {}".format(dict_file))
+    return backend(dict_file).open(cancel)
+
+
+def rewrite_media_paths(html):
+    """
+    1. convert the media path to actual path in anki's collection media folder.
+    2. remove the js codes (js inside will expires.)
+
+    :return: (html, media files referenced, css files referenced)
+    """
+    media_files_set = set()
+    mcss = []
+
+    def rewrite_img(m):
+        path = m.group(1)
+        if not _IMG_PATH_RE.match(path):
+            return m.group(0)
+        media_files_set.add(path)
+        return u'src="{}"'.format(_media_name(path))
+
+    def rewrite(m):
+        if m.group('sound_link'):
+            # find sounds
+            path = m.group('sound')
+            if 1:  # config.export_media
+                media_files_set.add(path)
+            # the label may hold an icon of its own
+            return u"[sound:{}]{}".format(_media_name(path), _MEDIA_REF_RE.sub(rewrite, m.group('label')))
+        if m.group('img'):
+            return _IMG_SRC_RE.sub(rewrite_img, m.group('img'), 1)
+        attr, path = m.group('attr'), m.group('value')
+        if attr == 'href':
+            if _CSS_PATH_RE.match(path):
+                mcss.append(path)
+            else:
+                sound = _SOUND_PATH_RE.match(path)
+                if not sound:
+                    return m.group(0)
+                path = sound.group(1)
+                media_files_set.add(path)
+                return u'href="sound:{}"'.format(_media_name(path))
+        elif not _JS_PATH_RE.match(path):
+            return m.group(0)
+        media_files_set.add(path)
+        return u'{}="{}"'.format(attr, _media_name(path))
+
+    html = _MEDIA_REF_RE.sub(rewrite, html)
+    return html, media_files_set, mcss
+
+
+def missing_css_files(css_files):
+    """
+    if not exists the css file, the user can place the file to media folder first,
+    and it will also execute the wrap process to generate the desired file.
+    """
+    missed_css = set()
+    for cssfile in css_files:
+        cssfile = '_' + os.path.basename(cssfile.replace('\\', os.path.sep))
+        if not os.path.exists(cssfile):
+            missed_css.add(cssfile[1:])
+    return missed_css
+
+
+def save_mdd_file(builder, filepath_in_mdx, savepath=None):
+    basename = os.path.basename(filepath_in_mdx.replace('\\', os.path.sep))
+    if savepath is None:
+        savepath = '_' + basename
+    if os.path.exists(savepath):
+        return
+    bytes_list = builder.mdd_lookup(filepath_in_mdx)
+    if bytes_list:
+        with open(savepath, 'wb') as f:
+            f.write(bytes_list[0])
+            return savepath
+
+
+def save_media_files(builder, data, resolved=None, failures=None):
+    """
+    get the necessary static files from local mdx dictionary
+    ** kwargs: data = list
+    ** kwargs: resolved = {file name: found in MDD}, shared between calls so every file is resolved only once
+    ** kwargs: failures = list, receives (file name, traceback) of the files which could not be read or written
+
+    files already in the media folder are skipped before the MDD is even queried.
+    """
+    if failures is None:
+        failures = []
+    if resolved is None:
+        resolved = {}
+    errors = list()
+    pending = set()
+    for each in data:
+        basename = os.path.basename(each.replace('\\', os.path.sep))
+        if basename in resolved:
+            if not resolved[basename]:
+                errors.append('*' + basename)
+        elif os.path.exists('_' + basename):
+            resolved[basename] = True
+        else:
+            pending.add(basename)
+    if not pending:
+        return errors
+
+    try:
+        keys = builder.mdd_keys_by_basename(pending)
+    except sqlite3.OperationalError:
+        failures.append((u", ".join(sorted(pending)), _format_exc()))
+        keys = {}
+    for basename in pending:
+        found = keys.get(mdict_query.mdd_basename(basename), [])
+        resolved[basename] = bool(found)
+        if not found:
+            errors.append('*' + basename)
+        for each in found:
+            try:
+                save_mdd_file(builder, each)
+            except (sqlite3.OperationalError, EnvironmentError):
+                failures.append((basename, _format_exc()))
+    return errors
+
+
+def _format_exc():
+    return six.ensure_text(traceback.format_exc(), errors="replace")
+
+
+def render_usage(opened_dict, html):
+    """
+    adapt a Kindle usage sentence to Anki, media is looked up in the dictionary that defined the word if any
+    """
+    html, media_files, css_files = rewrite_media_paths(html)
+    if opened_dict:
+        opened_dict.save_media(media_files)
+    return html
+
+
+def file_md5(path, chunk_size=1 << 16):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class AssetManifest(object):
+    """
+    css / js files shipped along with a MDX, with their size, mtime and md5.
+
+    The manifest is saved next to the MDX as ``<mdx>.assets.json``: the directory is walked once per session and
+    only new or modified files are hashed again. A file is copied to the media folder only if it is missing there
+    or its content differs, and at most once per session.
+    """
+    VERSION = 1
+
+    def __init__(self, mdx_file):
+        self.path = mdx_file + ".assets.json"
+        self.dir = os.path.split(mdx_file)[0]
+        # file name -> {"path", "size", "mtime", "md5"}, the last one walked wins like the former copy loop did
+        self.assets = OrderedDict()
+        self._synced = set()  # names in the media folder known to be up to date
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                saved = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if saved.get("version") != self.VERSION:
+            return {}
+        return dict((entry["path"], entry) for entry in saved.get("assets", []))
+
+    def _save(self):
+        try:
+            with open(self.path, 'w') as f:
+                json.dump({"version": self.VERSION, "assets": list(self.assets.values())}, f)
+        except (IOError, OSError):
+            pass  # read-only dictionary folder, the manifest is rebuilt next session
+
+    def scan(self):
+        saved = self._load()
+        changed = False
+        self.assets.clear()
+        for root, dirs, files in os.walk(self.dir):
+            for _mfile in [f for f in files if os.path.splitext(f)[1].strip().upper() in INCLUDE_MDX_EXTRAS]:
+                full_path = os.path.join(root, _mfile)
+                rel_path = os.path.relpath(full_path, self.dir)
+                try:
+                    st = os.stat(full_path)
+                except OSError:
+                    continue
+                entry = saved.pop(rel_path, None)
+                if not entry or entry["size"] != st.st_size or entry["mtime"] != st.st_mtime:
+                    entry = {"path": rel_path, "size": st.st_size, "mtime": st.st_mtime, "md5": file_md5(full_path)}
+                    changed = True
+                self.assets.pop(_mfile, None)
+                self.assets[_mfile] = entry
+        if changed or saved:
+            self._save()
+
+    def _is_synced(self, media_file, entry):
+        try:
+            if os.path.getsize(media_file) != entry["size"]:
+                return False
+            return file_md5(media_file) == entry["md5"]
+        except (IOError, OSError):
+            return False
+
+    def sync(self, missed_css):
+        """
+        copy the assets to the media folder (current directory), css files referenced by a definition but
+        missing from the media folder are copied with the leading underscore the definition expects.
+        """
+        copied = []
+        for _mfile, entry in self.assets.items():
+            _nfile = _mfile
+            if _mfile in missed_css:
+                _nfile = "_" + _mfile
+            if _nfile in self._synced:
+                continue
+            if not self._is_synced(_nfile, entry):
+                shutil.copy(os.path.join(self.dir, entry["path"]), _nfile)
+                copied.append(_nfile)
+            self._synced.add(_nfile)
+        return copied
+
+
+class DefinitionCache(object):
+    """
+    Rendered definitions of a MDX kept across import runs in ``<mdx>.defs.db``, words missing from the dictionary
+    are remembered too.
+
+    Rows are keyed by the fingerprint of the MDX file and the index version: they are dropped as soon as the
+    dictionary is replaced or the index format changes.
+
+    The cache is disabled for the rest of the session by the first error, which is kept in ``error``.
+    """
+    VERSION = 1
+    _FLUSH_SIZE = 200
+
+    def __init__(self, mdx_file, fingerprint=None):
+        self.db = os.path.splitext(mdx_file)[0] + ".defs.db"
+        if fingerprint is None:
+            fingerprint = mdict_query.file_fingerprint(mdx_file)
+        self.dict_key = u"{}:{}:{}".format(fingerprint, mdict_query.version, self.VERSION)
+        self.hits = 0
+        self.error = None  # traceback of the error which disabled the cache
+        self._conn = None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def open(self):
+        try:
+            conn = sqlite3.connect(self.db, check_same_thread=False)
+            conn.execute(
+                ''' CREATE TABLE IF NOT EXISTS DEFINITIONS
+                   (dict_key text not null,
+                    word text not null,
+                    html text,
+                    media_files text,
+                    css_files text,
+                    PRIMARY KEY (dict_key, word)
+                    )'''
+            )
+            conn.execute('DELETE FROM DEFINITIONS WHERE dict_key != ?', (self.dict_key,))
+            conn.commit()
+        except sqlite3.Error:
+            # read-only dictionary folder, import without cache
+            self.error = _format_exc()
+            return False
+        self._conn = conn
+        return True
+
+    def get_many(self, words):
+        """
+        :return: {word: CachedDefinition, or None if the dictionary doesn't have the word} for the cached words
+        """
+        cached = {}
+        if self._conn is None:
+            return cached
+        words = list(words)
+        with self._lock:
+            for i in range(0, len(words), mdict_query._SQL_IN_CHUNK - 1):
+                chunk = words[i:i + mdict_query._SQL_IN_CHUNK - 1]
+                sql = u'SELECT word, html, media_files, css_files FROM DEFINITIONS ' \
+                      u'WHERE dict_key = ? AND word IN ({})'.format(','.join('?' * len(chunk)))
+                for word, html, media_files, css_files in self._conn.execute(sql, [self.dict_key] + chunk):
+                    if html is None:
+                        cached[word] = None
+                    else:
+                        cached[word] = CachedDefinition(html, json.loads(media_files), json.loads(css_files))
+            self.hits += len(cached)
+        return cached
+
+    def put(self, word, definition):
+        """
+        :param definition: CachedDefinition, None if the dictionary doesn't have the word
+        """
+        if self._conn is None:
+            return
+        if definition is None:
+            row = (self.dict_key, word, None, None, None)
+        else:
+            row = (self.dict_key, word, definition.html,
+                   json.dumps(sorted(definition.media_files)), json.dumps(list(definition.css_files)))
+        with self._lock:
+            self._pending.append(row)
+            if len(self._pending) >= self._FLUSH_SIZE:
+                self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        try:
+            self._conn.executemany('INSERT OR REPLACE INTO DEFINITIONS VALUES (?,?,?,?,?)', self._pending)
+            self._conn.commit()
+        except sqlite3.Error:
+            # disk full or database locked, don't try again for every batch
+            self.error = _format_exc()
+            self._conn.close()
+            self._conn = None
+        self._pending = []
+
+    def close(self):
+        with self._lock:
+            if self._conn is None:
+                return
+            self._flush()
+            self._conn.close()
+            self._conn = None
+
+
+class OpenedDict(object):
+    """
+    One dictionary opened by :class:`DictSession`, through its backend.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.dict_file = backend.dict_file
+        self.name = os.path.splitext(os.path.basename(self.dict_file))[0]
+        self.dir = os.path.split(self.dict_file)[0]
+        self.assets = None  # AssetManifest, scanned on the first rendered definition
+        # media file name -> found in the MDD, for the whole session
+        self.resolved_media = {}
+        # (media file name, traceback) of the media files which could not be extracted
+        self.media_failures = []
+        self._media_lock = threading.Lock()
+        self.cache = None  # DefinitionCache, if enabled for the session
+
+    def render(self, record, word=None):
+        """
+        adapt a looked up record to Anki, extracting its media files and copying the dictionary's css/js files
+
+        :param record: raw record from the MDX, or CachedDefinition from an earlier import
+        :param word: the word looked up, its rendered definition is cached when given
+        """
+        if isinstance(record, CachedDefinition):
+            html, media_files, css_files = record
+        else:
+            html, media_files, css_files = rewrite_media_paths(record)
+            if word and self.cache is not None:
+                self.cache.put(word, CachedDefinition(html, media_files, css_files))
+        self.save_media(media_files)
+        missed_css = missing_css_files(css_files)
+        if html:
+            self.copy_assets(missed_css)
+        return html
+
+    def save_media(self, media_files):
+        with self._media_lock:
+            return save_media_files(self.backend.media, media_files, self.resolved_media, self.media_failures)
+
+    def copy_assets(self, missed_css):
+        with _ASSET_LOCK:
+            if self.assets is None:
+                self.assets = AssetManifest(self.dict_file)
+                self.assets.scan()
+            self.assets.sync(missed_css)
+
+
+class DictSession(object):
+    """
+    Opens every configured dictionary once per import run, MDX or StarDict, see DICT_BACKENDS.
+
+    Header, encoding, stylesheet and file handles of each dictionary are kept alive and reused for all words,
+    instead of building a fresh IndexBuilder for every single word.
+    """
+
+    def __init__(self, dict_files, use_cache=True):
+        self.dict_files = [m for m in dict_files if m and os.path.isfile(m)]
+        self.use_cache = use_cache
+        self.dicts = []
+        self.opened = False
+        self.errors = []  # [(dict_file, exception), ]
+        self.check_stats = {}  # {.mdx / .mdd file: check_stats} of the indexes built with check, see open_index
+        self.stats = {
+            "dicts_opened": 0,
+            "open_seconds": 0.0,
+            "lookups": 0,
+            "lookup_seconds": 0.0,
+            "block_cache_hits": 0,
+            "block_cache_misses": 0,
+            "media_resolved": 0,
+            "definition_cache_hits": 0,
+        }
+        self._stats_lock = threading.Lock()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def open(self, cancel=None):
+        """
+        open the dictionaries, may build their indexes: call it off the GUI thread. Opening twice is a no-op
+
+        :param cancel: threading.Event stopping an index build with mdict_query.BuildCancelled
+        """
+        if self.opened:
+            return
+        self.opened = True
+        for dict_file in self.dict_files:
+            start = time.time()
+            try:
+                backend = open_backend(dict_file, cancel)
+            except (MemoryError, TypeError, ValueError) as e:
+                self.errors.append((dict_file, e))
+                continue
+            opened_dict = OpenedDict(backend)
+            if self.use_cache:
+                # kept even if it could not be opened, a disabled cache reports its error
+                opened_dict.cache = DefinitionCache(dict_file, backend.fingerprint())
+                opened_dict.cache.open()
+            self.dicts.append(opened_dict)
+            self.stats["dicts_opened"] += 1
+            self.stats["open_seconds"] += time.time() - start
+            self.check_stats.update(backend.check_stats)
+
+    def close(self):
+        for d in self.dicts:
+            cache_stats = d.backend.block_cache_stats
+            self.stats["block_cache_hits"] += cache_stats['hits']
+            self.stats["block_cache_misses"] += cache_stats['misses']
+            self.stats["media_resolved"] += len(d.resolved_media)
+            if d.cache:
+                self.stats["definition_cache_hits"] += d.cache.hits
+                d.cache.close()
+            d.backend.close()
+        self.dicts = []
+        self.opened = False
+
+    @contextmanager
+    def timed_lookup(self, count=1):
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self._stats_lock:
+                self.stats["lookups"] += count
+                self.stats["lookup_seconds"] += time.time() - start
+
+    def lookup_many(self, words):
+        """
+        batch lookup of all words against the opened dictionaries in order, MDX @@@LINK= redirects are followed
+
+        :return: {word: (OpenedDict, record)} using the first dictionary that has the word, record is
+            a CachedDefinition for the words already rendered by an earlier import
+        """
+        found = {}
+        words = set(w for w in words if w)
+        for opened_dict in self.dicts:
+            pending = [w for w in words if w not in found]
+            if not pending:
+                break
+            if opened_dict.cache:
+                cached = opened_dict.cache.get_many(pending)
+                for word, definition in cached.items():
+                    if definition is not None:
+                        found[word] = (opened_dict, definition)
+                pending = [w for w in pending if w not in cached]
+                if not pending:
+                    continue
+            with self.timed_lookup(len(pending)):
+                records = self._lookup_following_links(opened_dict.backend, pending)
+            for word, record in records.items():
+                found[word] = (opened_dict, record)
+            if opened_dict.cache:
+                for word in pending:
+                    if word not in records:
+                        opened_dict.cache.put(word, None)
+        return found
+
+    @staticmethod
+    def _lookup_following_links(backend, words):
+        records = {}
+        # word asked for -> word to look up in this round
+        targets = dict((w, w) for w in words)
+        for _ in range(MAX_LINK_DEPTH + 1):
+            if not targets:
+                break
+            results = backend.lookup_many(targets.values())
+            redirects = {}
+            for word, target in targets.items():
+                result = results.get(target)
+                if not result:
+                    continue
+                if result[0].upper().find(LINK_PREFIX) > -1:
+                    # redirect to a new word behind the equal symbol.
+                    redirects[word] = result[0][len(LINK_PREFIX):].strip()
+                else:
+                    records[word] = result[0]
+            targets = redirects
+        return records
+
+    def summary(self):
+        summary = "AnKindle: opened {} dictionaries in {:.2f}s, {} lookups in {:.2f}s, " \
+                  "record block cache {} hits / {} misses, {} unique media files, {} cached definitions".format(
+            self.stats["dicts_opened"], self.stats["open_seconds"],
+            self.stats["lookups"], self.stats["lookup_seconds"],
+            self.stats["block_cache_hits"], self.stats["block_cache_misses"],
+            self.stats["media_resolved"], self.stats["definition_cache_hits"])
+        if self.check_stats:
+            summary += ", " + check_summary(self.check_stats)
+        return summary
@@ -3,32 +3,31 @@
 # Project : AnKindle
 import os
 import re
-import shutil
-import sqlite3
 from functools import partial
 from operator import itemgetter
 
 import anki
 from anki import notes
 from anki.lang import currentLang
+from anki.utils import splitFields, stripHTMLMedia
 from aqt import QAbstractTableModel, Qt, QAbstractItemView, isWin
 from aqt import QDialog, QVBoxLayout, QFrame, \
     QPushButton, QSpacerItem, QLabel, QHBoxLayout, QSizePolicy, QGroupBox, QComboBox, QCheckBox, QTabWidget, QTableView, \
-    QIcon
+    QIcon, QProgressDialog
 from aqt import mw, QSize
 from aqt.importing import importFile
 from aqt.progress import ProgressManager
 from aqt.studydeck import StudyDeck
-from aqt.utils import showInfo, getFile, showText, openLink, askUser
+from aqt.utils import showInfo, getFile, showText, openLink, askUser, tooltip
 from .config import Config
 from .const import ADDON_CD, __version__, ONLINE_DOC_URL, DEFAULT_TEMPLATE
 from .db import VocabDB
+from .dictionary import DictSession
+from .importer import ImportPipeline, query_word
 from .kkLib import IS_PY3K
 from .kkLib import WeChatButton, MoreAddonButton, VoteButton, _ImageButton, UpgradeButton, AddonUpdater, HLine, VLine
 from .lang import _trans
 from .libs import six
-from .libs.mdict import mdict_query
-from .libs.mdict import readmdict
 
 
 class _HelpBtn(_ImageButton):
@@ -196,15 +195,13 @@ class Window(QDialog):
         self.model = None
         self.deck = None
         self.mdx = None
-        self.builder = None
+        self._pipeline = None
         self._preload_data = None
         self._lang_config_dict = {}
         self.db = None
         self.preview_words_win = WordsView(self)
         self.on_select_kindle_db(False)
 
-        self.missed_css = set()
-
         # init actions
         self.btn_import.setDefault(True)
         try:
@@ -383,7 +380,7 @@ class Window(QDialog):
             self.mdx = file_path
         else:
             if not ignore_selection:
-                self.mdx = getFile(self, _trans("MDX TYPE"), lambda x: x, ("MDict (*.MDX)"),
+                self.mdx = getFile(self, _trans("MDX TYPE"), lambda x: x, ("MDict / StarDict (*.MDX *.IFO)"),
                                    os.path.join(os.path.dirname(__file__),
                                                 u"resource") if not self.mdx else os.path.dirname(self.mdx)
                                    )
@@ -396,95 +393,6 @@ class Window(QDialog):
         else:
             self.btn_3select_mdx.setText(_trans("SELECT MDX"))
 
-    def get_html(self, word, builder):
-        html = ''
-        if not builder:
-            return html
-
-        try:
-            result = builder.mdx_lookup(word)  # self.word: six.ensure_text
-        except AttributeError:
-            return ''
-
-        if result:
-            if result[0].upper().find(u"@@@LINK=") > -1:
-                # redirect to a new word behind the equal symol.
-                word = result[0][len(u"@@@LINK="):].strip()
-                return self.get_html(word, builder)
-            else:
-                html = self.adapt_to_anki(result[0])
-        return html
-
-    def save_file(self, filepath_in_mdx, savepath=None):
-        basename = os.path.basename(filepath_in_mdx.replace('\\', os.path.sep))
-        if savepath is None:
-            savepath = '_' + basename
-        try:
-            bytes_list = self.builder.mdd_lookup(filepath_in_mdx)
-            if bytes_list and not os.path.exists(savepath):
-                with open(savepath, 'wb') as f:
-                    f.write(bytes_list[0])
-                    return savepath
-        except sqlite3.OperationalError as e:
-            showInfo(str(e))
-
-    def save_media_files(self, data):
-        """
-        get the necessary static files from local mdx dictionary
-        ** kwargs: data = list
-        """
-        # diff = data.difference(self.media_cache['files'])
-        # self.media_cache['files'].update(diff)
-        lst, errors = list(), list()
-        wild = [
-            '*' + os.path.basename(each.replace('\\', os.path.sep)) for each in data]
-        try:
-            for each in wild:
-                keys = self.builder.get_mdd_keys(each)
-                if not keys:
-                    errors.append(each)
-                lst.extend(keys)
-            for each in lst:
-                self.save_file(each)
-        except AttributeError:
-            pass
-
-        return errors
-
-    def adapt_to_anki(self, html):
-        """
-        1. convert the media path to actual path in anki's collection media folder.
-        2. remove the js codes (js inside will expires.)
-        """
-        # convert media path, save media files
-        media_files_set = set()
-        mcss = re.findall(r'href="(\S+?\.css)"', html)
-        media_files_set.update(set(mcss))
-        mjs = re.findall(r'src="([\w\./]\S+?\.js)"', html)
-        media_files_set.update(set(mjs))
-        msrc = re.findall(r'<img.*?src="([\w\./]\S+?)".*?>', html)
-        media_files_set.update(set(msrc))
-        msound = re.findall(r'href="sound:(.*?\.(?:mp3|wav))"', html)
-        if 1:  # config.export_media
-            media_files_set.update(set(msound))
-        for each in media_files_set:
-            html = html.replace(each, u'_' + each.split('/')[-1])
-        # find sounds
-        p = re.compile(
-            r'<a[^>]+?href=\"(sound:_.*?\.(?:mp3|wav))\"[^>]*?>(.*?)</a>')
-        html = p.sub(u"[\\1]\\2", html)
-        self.save_media_files(media_files_set)
-        for cssfile in mcss:
-            cssfile = '_' + \
-                      os.path.basename(cssfile.replace('\\', os.path.sep))
-            # if not exists the css file, the user can place the file to media
-            # folder first, and it will also execute the wrap process to generate
-            # the desired file.
-            if not os.path.exists(cssfile):
-                self.missed_css.add(cssfile[1:])
-
-        return html
-
     @property
     def lang_config(self):
         return Config.lang_config.get(self.current_mdx_lang, {"model_id": u"",
@@ -522,120 +430,141 @@ class Window(QDialog):
                 langs.add(lang.upper())
         return list(langs)
 
-    def yield_one_word(self, filter_lang=''):
+    def filtered_word_data(self, filter_lang=''):
+        """
+        reload the words from Kindle and keep those of the filter language (current language by default)
+
+        :return: list of words, None if Kindle is not online any more
+        """
         self._preload_data = None
         # validate db still online
         if not self.on_select_kindle_db(False):
             showInfo(_trans("ENSURE USB"), mw, type="warning", title=_trans("ANKINDLE"))
-            return
-        progress = ProgressManager(mw)
-        progress.start(immediate=True)
-        words = self.word_data
-        for i, _ in enumerate(words):
-            progress.update(_trans("IMPORTING") + "\n{} / {}".format(i + 1, len(words)), i, True)
-            (id, word, stem, lang, added_tm, usage, title, authors, category) = _
-            if lang and (lang.upper() != (filter_lang if filter_lang else self.current_mdx_lang)):
-                continue
-            yield id, word, stem, lang, added_tm, usage, title, authors, category
-
-        progress.finish()
+            return None
+        filter_lang = filter_lang if filter_lang else self.current_mdx_lang
+        return [_ for _ in self.word_data if not (_[3] and _[3].upper() != filter_lang)]
 
     def on_import(self):
         from . import _try_ext_module
 
-        total_new = 0
-        total_dup = 0
-        for i, _ in enumerate(self.yield_one_word()):
-            (id, word, stem, lang, added_tm, usage, title, authors, category) = _
-            # region save new cards
-            try:
-                note = notes.Note(mw.col, mw.col.models.models[str(self.model['id'])])
-            except KeyError:
-                continue
-            note.model()['did'] = self.deck['id']
+        if self._pipeline:
+            return
 
-            qry_word = stem if stem else word if word else ''
+        if _try_ext_module():
+            mdx_files = self.MDXFiles
+        else:
+            mdx_files = [self.mdx, ]
+        mdx_files = [m for m in mdx_files if m and os.path.isfile(m)]
+        if not any(mdx_files):
+            ret = askUser(
+                _trans("ALERT FOR MISSING MDX"), self, defaultno=False, title=_trans("ANKINDLE")
+            )
+            if not ret:
+                return
+
+        words = self.filtered_word_data()
+        if words is None:
+            return
+        try:
+            self._import_model = mw.col.models.models[str(self.model['id'])]
+        except KeyError:
+            return
+        self._import_model['did'] = self.deck['id']
 
-            if _try_ext_module():
-                mdx_files = self.MDXFiles
-            else:
-                mdx_files = [self.mdx, ]
-            mdx_files = [m for m in mdx_files if os.path.isfile(m)]
-            if not any(mdx_files):
-                ret = askUser(
-                    _trans("ALERT FOR MISSING MDX"), self, defaultno=False, title=_trans("ANKINDLE")
-                )
-                if not ret:
-                    break
-            dict_nm = ''
-            dict_data = ''
-            for mdx_file in mdx_files:
-                self.builder = mdict_query.IndexBuilder(mdx_file)
-                self.builder.get_header()
-                self.builder.check_build()
-                try:
-                    mdx_dict = readmdict.MDX(mdx_file, only_header=True)
-                    self.builder._encoding = mdx_dict._encoding
-                except MemoryError:
-                    showInfo(_trans("MDX MEMORY ERROR"), self, type="warning", title=_trans("ANKINDLE"))
-                    continue
-                except TypeError:
-                    showInfo(_trans("MDX TYPE ERROR"), self, type="warning", title=_trans("ANKINDLE"))
-                    continue
-                dict_nm = os.path.splitext(os.path.basename(mdx_dict._fname))[0]
-
-                self.missed_css = set()
-                dict_data = self.get_html(qry_word, self.builder)
-                # copy css files
-                if dict_data:
-                    mdx_dict_dir = os.path.split(mdx_file)[0]
-                    include_mdx_extras = ['.CSS', '.JS']
-                    for root, dirs, files in os.walk(mdx_dict_dir):
-                        for _mfile in [css for css in files if os.path.splitext(css)
-                                                               [1].strip().upper() in include_mdx_extras]:
-                            _nfile = _mfile
-                            if _mfile in self.missed_css:
-                                _nfile = "_" + _mfile
-                            shutil.copy(
-                                os.path.join(root, _mfile),
-                                _nfile
-                            )
-                    break
-
-            _usage = self.adapt_to_anki(usage.replace(word, u"<b>%s</b>" % word)) if usage else ''
-            try:
-                _id_in_field = re.sub("[^0-9a-zA-Z]", "", qry_word + usage).strip().upper()
-            except TypeError:
-                return False
-
-            def update_note(_note):
-                _note.fields[_note._fieldOrd('id')] = _id_in_field if _id_in_field else ''
-                _note.fields[_note._fieldOrd('word')] = word if word else ''
-                _note.fields[_note._fieldOrd('stem')] = stem if stem else ''
-                _note.fields[_note._fieldOrd('lang')] = lang if lang else ''
-                _note.fields[_note._fieldOrd('creation_tm')] = added_tm if added_tm else ''
-                _note.fields[_note._fieldOrd('usage')] = _usage if _usage else ''
-                _note.fields[_note._fieldOrd('title')] = title if title else ''
-                _note.fields[_note._fieldOrd('authors')] = authors if authors else ''
-                _note.fields[_note._fieldOrd('mdx_dict')] = dict_data
-
-                try:
-                    _note.fields[_note._fieldOrd('mdx_name')] = dict_nm
-                except KeyError:
-                    pass
-                return True
-
-            if update_note(note):
-                if note.dupeOrEmpty() != 2:
-                    mw.col.addNote(note)
-                    total_new += 1
-                else:
-                    total_dup += 1
-                mw.col.autosave()
-                # endregion
+        # the dictionaries are opened by the pipeline, off the GUI thread
+        session = DictSession(mdx_files)
+
+        self._existing_fields = self._existing_first_fields()
+        self._import_totals = [0, 0]  # new, duplicates
+        self.btn_import.setEnabled(False)
+
+        self._pipeline = ImportPipeline(self, session, words)
+        self._import_progress = QProgressDialog(_trans("IMPORTING"), anki.lang._("Cancel"), 0, len(words), self)
+        self._import_progress.setWindowModality(Qt.WindowModal)
+        self._import_progress.setMinimumDuration(0)
+        self._import_progress.canceled.connect(self._pipeline.cancel)
+        self._pipeline.batch_ready.connect(self.on_import_batch)
+        self._pipeline.progress.connect(self.on_import_progress)
+        self._pipeline.finished.connect(self.on_import_finished)
+        self._pipeline.start()
+
+    def _existing_first_fields(self):
+        """
+        first field of all notes of the selected model, loaded once per import for duplicate checks
+        """
+        return set(stripHTMLMedia(splitFields(flds)[0]) for flds in
+                   mw.col.db.list("select flds from notes where mid = ?", self.model['id']))
 
+    def _build_note(self, prepared):
+        (id, word, stem, lang, added_tm, usage, title, authors, category) = prepared.row
+        note = notes.Note(mw.col, self._import_model)
+
+        qry_word = query_word(prepared.row)
+        try:
+            _id_in_field = re.sub("[^0-9a-zA-Z]", "", qry_word + usage).strip().upper()
+        except TypeError:
+            return None
+
+        note.fields[note._fieldOrd('id')] = _id_in_field if _id_in_field else ''
+        note.fields[note._fieldOrd('word')] = word if word else ''
+        note.fields[note._fieldOrd('stem')] = stem if stem else ''
+        note.fields[note._fieldOrd('lang')] = lang if lang else ''
+        note.fields[note._fieldOrd('creation_tm')] = added_tm if added_tm else ''
+        note.fields[note._fieldOrd('usage')] = prepared.usage if prepared.usage else ''
+        note.fields[note._fieldOrd('title')] = title if title else ''
+        note.fields[note._fieldOrd('authors')] = authors if authors else ''
+        note.fields[note._fieldOrd('mdx_dict')] = prepared.dict_data
+
+        try:
+            note.fields[note._fieldOrd('mdx_name')] = prepared.dict_nm
+        except KeyError:
+            pass
+        return note
+
+    def on_import_batch(self, batch):
+        """
+        add one batch of prepared words on the main thread, the collection is saved once the import finishes
+        """
+        for prepared in batch:
+            note = self._build_note(prepared)
+            if not note:
+                continue
+            # same rule as note.dupeOrEmpty(), without a query per note
+            first_field = stripHTMLMedia(note.fields[0])
+            if not first_field.strip() or first_field not in self._existing_fields:
+                self._existing_fields.add(first_field)
+                mw.col.addNote(note)
+                self._import_totals[0] += 1
+            else:
+                self._import_totals[1] += 1
+        self._pipeline.batch_done()
+
+    def on_import_progress(self, done, total):
+        self._import_progress.setLabelText(_trans("IMPORTING") + "\n{} / {}".format(done, total))
+        self._import_progress.setValue(done)
+
+    def on_import_finished(self):
+        pipeline, self._pipeline = self._pipeline, None
+        self._import_progress.close()
+        mw.col.save()
+        pipeline.session.close()
+        tooltip(pipeline.session.summary(), period=5000, parent=mw)
+        self.btn_import.setEnabled(True)
+
+        total_new, total_dup = self._import_totals
         mw.moveToState("deckBrowser")
+        self._show_dict_errors(pipeline.session.errors)
         showText(_trans("CREATED AND DUPLICATES") % (total_new, total_dup), self)
+        if pipeline.errors:
+            what, tb = pipeline.errors[0]
+            showText(_trans("IMPORT ERRORS") % (len(pipeline.errors), what, tb), self, title=_trans("ANKINDLE"))
+
+    def _show_dict_errors(self, errors):
+        for mdx_file, e in errors:
+            if isinstance(e, MemoryError):
+                showInfo(_trans("MDX MEMORY ERROR"), self, type="warning", title=_trans("ANKINDLE"))
+            else:
+                showInfo(_trans("MDX TYPE ERROR"), self, type="warning", title=_trans("ANKINDLE"))
 
     def on_preview_words(self):
         self.preview_words_win.lang = self.current_mdx_lang
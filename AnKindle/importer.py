@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+# Created: 10/18/2026
+# Project : AnKindle
+import threading
+import traceback
+from collections import namedtuple
+
+from aqt import QThread, pyqtSignal
+from .const import IMPORT_BATCH_SIZE
+from .dictionary import render_usage
+from .libs.mdict.mdict_query import BuildCancelled
+from .libs import six
+
+queue = six.moves.queue
+
+# one Kindle word ready to be saved as note, dict_data and usage are already adapted to Anki
+PreparedWord = namedtuple("PreparedWord", ["row", "dict_nm", "dict_data", "usage"])
+
+_STOP = object()
+# seconds a blocked stage waits before it checks for cancellation again
+_POLL_INTERVAL = 0.1
+
+
+def query_word(row):
+    (id, word, stem, lang, added_tm, usage, title, authors, category) = row
+    return stem if stem else word if word else ''
+
+
+class ImportPipeline(QThread):
+    """
+    Opens the dictionaries, resolves definitions and extracts media for Kindle words off the GUI thread.
+
+    Stages: the dictionary session is opened, indexes are built if needed -> words are cut into batches -> definitions are looked up by a pool of workers -> media files are
+    extracted by a second pool -> batches are emitted in their original order through ``batch_ready``.
+    Notes must be added by the receiver on the main thread, which calls :meth:`batch_done` once a batch is saved.
+    All queues are bounded, and so is the number of batches between the feed and their emission: a slow batch
+    holds back at most ``max_batches_in_flight`` batches waiting to be emitted after it. Memory stays flat
+    whatever the size of vocab.db.
+
+    Failures never stop the other words, they are collected in ``errors`` as (what failed, traceback) for the
+    receiver to report once the pipeline is finished.
+    """
+    batch_ready = pyqtSignal(object)  # [PreparedWord, ]
+    progress = pyqtSignal(int, int)  # words done, words total
+
+    def __init__(self, parent, session, words, workers=2, batch_size=IMPORT_BATCH_SIZE, max_pending_batches=4,
+                 max_batches_in_flight=None):
+        super(ImportPipeline, self).__init__(parent)
+        self.session = session
+        self.words = words
+        self.workers = workers
+        self.batch_size = batch_size
+        self.errors = []  # [(what failed, traceback), ]
+
+        self._cancelled = threading.Event()
+        self._stopping = threading.Event()
+        self._lookup_queue = queue.Queue(max_pending_batches)
+        self._media_queue = queue.Queue(max_pending_batches)
+        self._done_queue = queue.Queue(max_pending_batches)
+        # one slot per batch emitted but not yet saved by the main thread
+        self._emitted_slots = queue.Queue(max_pending_batches)
+        # one slot per batch fed but not yet emitted, finished batches wait for the earlier ones in run()
+        self._in_flight_slots = queue.Queue(max_batches_in_flight or max_pending_batches * 3)
+        self._errors_lock = threading.Lock()
+
+    def cancel(self):
+        self._cancelled.set()
+        self._stopping.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def batch_done(self):
+        try:
+            self._emitted_slots.get_nowait()
+        except queue.Empty:
+            pass
+
+    # region bounded queue helpers, give up when stopping
+    def _put(self, q, item):
+        while not self._stopping.is_set():
+            try:
+                q.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self._stopping.is_set():
+            try:
+                return q.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return _STOP
+
+    # endregion
+
+    def _record_error(self, what):
+        """
+        keep the exception being handled along with its traceback
+        """
+        with self._errors_lock:
+            self.errors.append((what, six.ensure_text(traceback.format_exc(), errors="replace")))
+
+    def _stage(self, target):
+        """
+        run target as a pipeline stage, a stage that crashes stops the whole pipeline instead of stalling it
+        """
+
+        def run_stage():
+            try:
+                target()
+            except Exception:
+                self._record_error(target.__name__)
+                self._stopping.set()
+
+        return run_stage
+
+    def _feed(self):
+        for seq, i in enumerate(range(0, len(self.words), self.batch_size)):
+            if not self._put(self._in_flight_slots, seq):
+                return
+            if not self._put(self._lookup_queue, (seq, self.words[i:i + self.batch_size])):
+                return
+        for _ in range(self.workers):
+            self._put(self._lookup_queue, _STOP)
+
+    def _lookup_worker(self):
+        while True:
+            item = self._get(self._lookup_queue)
+            if item is _STOP:
+                self._put(self._media_queue, _STOP)
+                return
+            seq, rows = item
+            try:
+                definitions = self.session.lookup_many([query_word(row) for row in rows])
+            except Exception:
+                self._record_error(u"lookup of batch {}".format(seq))
+                definitions = {}
+            if not self._put(self._media_queue, (seq, rows, definitions)):
+                return
+
+    def _media_worker(self):
+        while True:
+            item = self._get(self._media_queue)
+            if item is _STOP:
+                return
+            seq, rows, definitions = item
+            batch = [self._prepare(row, definitions) for row in rows]
+            if not self._put(self._done_queue, (seq, batch)):
+                return
+
+    def _prepare(self, row, definitions):
+        (id, word, stem, lang, added_tm, usage, title, authors, category) = row
+        qry_word = query_word(row)
+        dict_nm = self.session.dicts[-1].name if self.session.dicts else ''
+        dict_data = ''
+        opened_dict = None
+        try:
+            if qry_word in definitions:
+                opened_dict, record = definitions[qry_word]
+                dict_nm = opened_dict.name
+                dict_data = opened_dict.render(record, qry_word)
+            _usage = render_usage(opened_dict, usage.replace(word, u"<b>%s</b>" % word)) if usage else ''
+        except Exception:
+            self._record_error(qry_word)
+            _usage = usage if usage else ''
+        return PreparedWord(row, dict_nm, dict_data, _usage)
+
+    def run(self):
+        # opening may build the indexes of the dictionaries, which must not happen on the GUI thread
+        try:
+            self.session.open(self._cancelled)
+        except BuildCancelled:
+            return
+        except Exception:
+            self._record_error(u"opening the dictionaries")
+            return
+
+        threads = [threading.Thread(target=self._stage(self._feed))]
+        threads += [threading.Thread(target=self._stage(self._lookup_worker)) for _ in range(self.workers)]
+        threads += [threading.Thread(target=self._stage(self._media_worker)) for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        total_batches = (len(self.words) + self.batch_size - 1) // self.batch_size
+        next_seq = 0
+        words_done = 0
+        buffered = {}
+        while next_seq < total_batches:
+            item = self._get(self._done_queue)
+            if item is _STOP:
+                break
+            seq, batch = item
+            buffered[seq] = batch
+            # emit in the original order of vocab.db
+            while next_seq in buffered and self._put(self._emitted_slots, next_seq):
+                batch = buffered.pop(next_seq)
+                self._in_flight_slots.get_nowait()
+                next_seq += 1
+                words_done += len(batch)
+                self.batch_ready.emit(batch)
+                self.progress.emit(words_done, len(self.words))
+            if self.cancelled:
+                break
+
+        # stop the workers in any case, the session must not be used after run() returns
+        self._stopping.set()
+        for thread in threads:
+            thread.join()
+        for opened_dict in self.session.dicts:
+            self.errors.extend(opened_dict.backend.errors)
+            for name, tb in opened_dict.media_failures:
+                self.errors.append((u"media file {}".format(name), tb))
+            if opened_dict.cache is not None and opened_dict.cache.error:
+                self.errors.append((u"definition cache of {}".format(opened_dict.name), opened_dict.cache.error))
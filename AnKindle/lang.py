@@ -34,6 +34,12 @@ trans = {
     'GET KINDLE DB': {'zh_CN': u'请手动选择Kindle数据库，。', 'en': u'Please select Kindle vocab database.'},
     "GET KINDLE CLIPPINGS": {'zh_CN': u'请手动选择 My Clippings.txt，。', 'en': u'Please select Kindle clippings file.'},
     'IMPORTING': {'zh_CN': u'正在导入生词', 'en': u'Importing'},
+    'INDEXING MDX': {'zh_CN': u'AnKindle 正在索引词典 %s (%s/%s)', 'en': u'AnKindle: indexing %s (%s/%s)'},
+    'STOP INDEXING': {'zh_CN': u'停止索引词典', 'en': u'Stop indexing dictionaries'},
+    'INDEXING FAILED': {'zh_CN': u'AnKindle 索引词典时发生 %s 个错误', 'en': u'AnKindle: %s errors while indexing'},
+    'IMPORT ERRORS': {'zh_CN': u'导入时发生 %s 个错误，部分卡片可能缺少释义或媒体文件。\n\n第一个错误（%s）：\n%s',
+                      'en': u'%s errors occurred during the import, some cards may lack their definition or media '
+                            u'files.\n\nFirst error (%s):\n%s'},
     # 'SELECT ORIG LANG': {'zh_CN': u'选择生词语言类型:', 'en': u'Language of words:'},
     'MANDATORY': {'zh_CN': u'<b>必选：</b>', 'en': u'<b>Mandatory:</b>'},
     'ALERT FOR MISSING MDX': {'zh_CN': u'您没有选择MDX文件，单词释义信息将不会被导入，确认继续吗？',
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Compact binary index of a MDX (``.mdx.idx``), an alternative to the MDX_INDEX table of the ``.mdx.db``.
+
+Layout, little endian:
+    header      magic, format version, number of entries, blocks and buckets, offsets of the sections below
+    blocks      one row per record block: file_pos, compressed_size, decompressed_size, record_block_type, offset
+    entries     one fixed-width row per key, in key order: block id, record_start, record_end
+    keys        utf-8 keys cut in buckets of BUCKET_SIZE, front-coded: the first key of a bucket is stored whole,
+                the others as (length of the prefix shared with the previous key, remaining suffix)
+    buckets     offset of every bucket in the keys section
+    meta        json, holds the fingerprint of the MDX the index was built from
+
+The file is memory-mapped, a lookup bisects the first keys of the buckets (read once, one key per bucket) and
+scans a single bucket.
+"""
+import json
+import mmap
+import shutil
+import struct
+import tempfile
+from bisect import bisect_left
+
+MAGIC = b'AKIX'
+VERSION = 1
+BUCKET_SIZE = 16
+
+_HEADER = struct.Struct('<4sIQIIQQQQQQQ')
+_BLOCK = struct.Struct('<QQQQQ')
+_ENTRY = struct.Struct('<IQQ')
+_KEY = struct.Struct('<H')
+_FRONT_CODED_KEY = struct.Struct('<HH')
+_BUCKET = struct.Struct('<Q')
+_MAX_KEY_LENGTH = 0xFFFF
+
+
+def _shared_prefix(a, b):
+    n = min(len(a), len(b), _MAX_KEY_LENGTH)
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def build(path, blocks, rows, meta, bucket_size=BUCKET_SIZE):
+    """
+    write a compact index, rows are streamed and never held in memory
+
+    :param blocks: [(file_pos, compressed_size, decompressed_size, record_block_type, offset), ] in file order
+    :param rows: MDX_INDEX rows (key_text, file_pos, compressed_size, decompressed_size, record_block_type,
+        record_start, record_end, offset) sorted by key_text, rows sharing a key in file order
+    :param meta: dict saved along with the index
+    """
+    block_ids = dict((block[0], i) for i, block in enumerate(blocks))
+    num_entries = 0
+    bucket_offsets = []
+    with open(path, 'wb') as f:
+        f.write(b'\x00' * _HEADER.size)
+        blocks_off = f.tell()
+        for block in blocks:
+            f.write(_BLOCK.pack(*block))
+        entries_off = f.tell()
+        # the keys are spooled aside while the entries are written, then appended
+        keys = tempfile.TemporaryFile()
+        try:
+            previous = b''
+            for row in rows:
+                key = row[0].encode('utf-8')
+                if len(key) > _MAX_KEY_LENGTH:
+                    raise ValueError("key too long for the compact index: {!r}".format(row[0]))
+                f.write(_ENTRY.pack(block_ids[row[1]], row[5], row[6]))
+                if num_entries % bucket_size == 0:
+                    bucket_offsets.append(keys.tell())
+                    keys.write(_KEY.pack(len(key)) + key)
+                else:
+                    prefix = _shared_prefix(previous, key)
+                    keys.write(_FRONT_CODED_KEY.pack(prefix, len(key) - prefix) + key[prefix:])
+                previous = key
+                num_entries += 1
+            keys_off = f.tell()
+            keys.seek(0)
+            shutil.copyfileobj(keys, f)
+        finally:
+            keys.close()
+        buckets_off = f.tell()
+        for offset in bucket_offsets:
+            f.write(_BUCKET.pack(offset))
+        meta_off = f.tell()
+        meta_bytes = json.dumps(meta).encode('utf-8')
+        f.write(meta_bytes)
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, VERSION, num_entries, len(blocks), bucket_size, len(bucket_offsets),
+                             blocks_off, entries_off, keys_off, buckets_off, meta_off, len(meta_bytes)))
+
+
+class CompactIndex(object):
+    """
+    read-only view of a ``.mdx.idx`` file, lookups return the same index dicts as the sqlite MDX_INDEX table
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            (magic, version, self.num_entries, num_blocks, self._bucket_size, self._num_buckets,
+             blocks_off, self._entries_off, self._keys_off, self._buckets_off,
+             meta_off, meta_len) = _HEADER.unpack_from(self._mm, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("not a compact index of version {}: {}".format(VERSION, path))
+            self.meta = json.loads(self._mm[meta_off:meta_off + meta_len].decode('utf-8'))
+        except (ValueError, EnvironmentError):
+            self.close()
+            raise
+        except struct.error:
+            self.close()
+            raise ValueError("truncated compact index: {}".format(path))
+        # the block table is small, one row per record block
+        self._blocks = [_BLOCK.unpack_from(self._mm, blocks_off + i * _BLOCK.size) for i in range(num_blocks)]
+        self._first_keys = None
+
+    def close(self):
+        mm = getattr(self, '_mm', None)
+        if mm is not None:
+            mm.close()
+            self._mm = None
+        self._file.close()
+
+    def _bucket_pos(self, bucket):
+        return self._keys_off + _BUCKET.unpack_from(self._mm, self._buckets_off + bucket * _BUCKET.size)[0]
+
+    def _first_key(self, bucket):
+        pos = self._bucket_pos(bucket)
+        length = _KEY.unpack_from(self._mm, pos)[0]
+        return self._mm[pos + _KEY.size:pos + _KEY.size + length]
+
+    @property
+    def first_keys(self):
+        if self._first_keys is None:
+            self._first_keys = [self._first_key(bucket) for bucket in range(self._num_buckets)]
+        return self._first_keys
+
+    def _bucket_keys(self, bucket):
+        """
+        yield (entry number, key) of every key in the bucket
+        """
+        mm = self._mm
+        pos = self._bucket_pos(bucket)
+        first = bucket * self._bucket_size
+        length = _KEY.unpack_from(mm, pos)[0]
+        pos += _KEY.size
+        key = mm[pos:pos + length]
+        pos += length
+        yield first, key
+        for i in range(first + 1, min(first + self._bucket_size, self.num_entries)):
+            prefix, length = _FRONT_CODED_KEY.unpack_from(mm, pos)
+            pos += _FRONT_CODED_KEY.size
+            key = key[:prefix] + mm[pos:pos + length]
+            pos += length
+            yield i, key
+
+    def _entry(self, i):
+        block_id, record_start, record_end = _ENTRY.unpack_from(self._mm, self._entries_off + i * _ENTRY.size)
+        file_pos, compressed_size, decompressed_size, record_block_type, offset = self._blocks[block_id]
+        return {
+            'file_pos': file_pos,
+            'compressed_size': compressed_size,
+            'decompressed_size': decompressed_size,
+            'record_block_type': record_block_type,
+            'record_start': record_start,
+            'record_end': record_end,
+            'offset': offset,
+        }
+
+    def lookup(self, key_text):
+        """
+        :return: index dicts of all the entries of the key, in file order
+        """
+        target = key_text.encode('utf-8')
+        # first bucket that may hold the key: the last one starting strictly before it
+        start = max(bisect_left(self.first_keys, target) - 1, 0)
+        indexes = []
+        for bucket in range(start, self._num_buckets):
+            for i, key in self._bucket_keys(bucket):
+                if key == target:
+                    indexes.append(self._entry(i))
+                elif key > target:
+                    return indexes
+        return indexes
+
+    def lookup_many(self, keywords):
+        """
+        :return: list of (key_text, index) sorted by the record's position in file, like
+            IndexBuilder.lookup_indexes_many
+        """
+        hits = []
+        for keyword in set(keywords):
+            hits.extend((keyword, index) for index in self.lookup(keyword))
+        hits.sort(key=lambda hit: (hit[1]['file_pos'], hit[1]['record_start']))
+        return hits
@@ -1,60 +1,99 @@
-import math
-
-
-class FlexBuffer():
-
-    def __init__(self):
-
-        self.blockSize = None
-        self.c = None
-        self.l = None
-        self.buf = None
-
-    def require(self, n):
-
-        r = self.c - self.l + n
-        if r > 0:
-            self.l = self.l + self.blockSize * math.ceil(r / self.blockSize)
-            # tmp = bytearray(self.l)
-            # for i in len(self.buf):
-            #    tmp[i] = self.buf[i]
-            # self.buf = tmp
-            self.buf = self.buf + bytearray(self.l - len(self.buf))
-        self.c = self.c + n
-        return self.buf
-
-    def alloc(self, initSize, blockSize):
-
-        if blockSize:
-            sz = blockSize
-        else:
-            sz = 4096
-        self.blockSize = self.roundUp(sz)
-        self.c = 0
-        self.l = self.roundUp(initSize) | 0
-        self.l += self.blockSize - (self.l % self.blockSize)
-        self.buf = bytearray(self.l)
-        return self.buf
-
-    def roundUp(self, n):
-
-        r = n % 4
-        if r == 0:
-            return n
-        else:
-            return n + 4 - r
-
-    def reset(self):
-
-        self.c = 0
-        self.l = len(self.buf)
-
-    def pack(self, size):
-
-        return self.buf[0:size]
-
-
-def _decompress(inBuf, outBuf):
+"""
+LZO1X decompression, used by the MDict engines < 2.0.
+
+liblzo2 is called through ctypes when it is installed, blocks are decoded in pure Python otherwise.
+"""
+import ctypes
+import ctypes.util
+
+# return code of __lzo_init_v2 and lzo1x_decompress_safe when they succeeded
+_LZO_E_OK = 0
+
+
+class _LzoCallback(ctypes.Structure):
+    # lzo_callback_t, only its size is checked by __lzo_init_v2
+    _fields_ = [('nalloc', ctypes.c_void_p), ('nfree', ctypes.c_void_p), ('nprogress', ctypes.c_void_p),
+                ('user1', ctypes.c_void_p), ('user2', ctypes.c_size_t), ('user3', ctypes.c_uint32)]
+
+
+def _lzo_init(lib):
+    """
+    lzo_init() of lzoconf.h: liblzo2 must be initialised once, and checks that it was built with the type sizes
+    given here, before anything is decompressed
+
+    :return: whether liblzo2 can be used
+    """
+    try:
+        lzo_version = lib.lzo_version
+        init = getattr(lib, '__lzo_init_v2')
+    except AttributeError:
+        return False
+    lzo_version.argtypes = []
+    lzo_version.restype = ctypes.c_uint
+    init.argtypes = [ctypes.c_uint] + [ctypes.c_int] * 9
+    init.restype = ctypes.c_int
+    pointer_size = ctypes.sizeof(ctypes.c_void_p)
+    return init(lzo_version(), ctypes.sizeof(ctypes.c_short), ctypes.sizeof(ctypes.c_int),
+                ctypes.sizeof(ctypes.c_long), ctypes.sizeof(ctypes.c_uint32), ctypes.sizeof(ctypes.c_size_t),
+                pointer_size, pointer_size, pointer_size, ctypes.sizeof(_LzoCallback)) == _LZO_E_OK
+
+
+def _load_lzo1x_decompress_safe():
+    """
+    :return: lzo1x_decompress_safe of the system liblzo2, None if liblzo2 is not installed or failed to initialise
+    """
+    for name in ('lzo2', 'liblzo2', 'liblzo2-2'):
+        path = ctypes.util.find_library(name)
+        if not path:
+            continue
+        try:
+            lib = ctypes.CDLL(path)
+            func = lib.lzo1x_decompress_safe
+        except (OSError, AttributeError):
+            continue
+        if not _lzo_init(lib):
+            continue
+        # int lzo1x_decompress_safe(const lzo_bytep src, lzo_uint src_len,
+        #                           lzo_bytep dst, lzo_uintp dst_len, lzo_voidp wrkmem)
+        func.argtypes = [ctypes.c_char_p, ctypes.c_size_t, ctypes.c_char_p, ctypes.POINTER(ctypes.c_size_t),
+                         ctypes.c_void_p]
+        func.restype = ctypes.c_int
+        return func
+    return None
+
+
+_lzo1x_decompress_safe = _load_lzo1x_decompress_safe()
+# ctypes releases the GIL around liblzo2, the pure Python decoder holds it for the whole block
+releases_gil = _lzo1x_decompress_safe is not None
+
+
+def _native_decompress(data, size):
+    """
+    :return: the decompressed block, None if liblzo2 could not decompress it into size bytes
+    """
+    out = ctypes.create_string_buffer(size)
+    out_len = ctypes.c_size_t(size)
+    if _lzo1x_decompress_safe(data, len(data), out, ctypes.byref(out_len), None) != _LZO_E_OK:
+        return None
+    return out.raw[:out_len.value]
+
+
+def _copy_overlapping_match(out, op, m_pos, t):
+    """
+    copy a match whose source overlaps its destination: the last op - m_pos bytes are repeated
+    """
+    if not 0 <= m_pos < op:
+        raise ValueError("corrupted LZO block: match outside of the output")
+    pattern = out[m_pos:op]
+    out[op:op + t] = (pattern * (t // len(pattern) + 1))[:t]
+
+
+def _decompress(in_buf, out):
+    """
+    :param in_buf: bytearray of the compressed block
+    :param out: bytearray preallocated to the decompressed size, it is grown by the slice assignments if too short
+    :return: the number of bytes written to out
+    """
     c_top_loop = 1
     c_first_literal_run = 2
     c_match = 3
@@ -62,13 +101,11 @@ def _decompress(inBuf, outBuf):
     c_match_done = 5
     c_match_next = 6
 
-    out = outBuf.buf
     op = 0
     ip = 0
-    t = inBuf[ip]
+    t = in_buf[ip]
     state = c_top_loop
     m_pos = 0
-    ip_end = len(inBuf)
 
     if t > 17:
         ip = ip + 1
@@ -76,61 +113,45 @@ def _decompress(inBuf, outBuf):
         if t < 4:
             state = c_match_next
         else:
-            out = outBuf.require(t)
-            while True:
-                out[op] = inBuf[ip]
-                op = op + 1
-                ip = ip + 1
-                t = t - 1
-                if not t > 0: break
+            out[op:op + t] = in_buf[ip:ip + t]
+            op = op + t
+            ip = ip + t
             state = c_first_literal_run
 
     while True:
-        if_block = False
-
         ##
         if state == c_top_loop:
-            t = inBuf[ip]
+            t = in_buf[ip]
             ip = ip + 1
             if t >= 16:
                 state = c_match
                 continue
             if t == 0:
-                while inBuf[ip] == 0:
+                while in_buf[ip] == 0:
                     t = t + 255
                     ip = ip + 1
-                t = t + 15 + inBuf[ip]
+                t = t + 15 + in_buf[ip]
                 ip = ip + 1
 
             t = t + 3
-            out = outBuf.require(t)
-            while True:
-                out[op] = inBuf[ip]
-                op = op + 1
-                ip = ip + 1
-                t = t - 1
-                if not t > 0: break
+            out[op:op + t] = in_buf[ip:ip + t]
+            op = op + t
+            ip = ip + t
             # emulate c switch
             state = c_first_literal_run
 
         ##
         if state == c_first_literal_run:
-            t = inBuf[ip]
+            t = in_buf[ip]
             ip = ip + 1
             if t >= 16:
                 state = c_match
                 continue
-            m_pos = op - 0x801 - (t >> 2) - (inBuf[ip] << 2)
+            m_pos = op - 0x801 - (t >> 2) - (in_buf[ip] << 2)
             ip = ip + 1
-            out = outBuf.require(3)
-            out[op] = out[m_pos]
-            op = op + 1
-            m_pos = m_pos + 1
-            out[op] = out[m_pos]
-            op = op + 1
-            m_pos = m_pos + 1
-            out[op] = out[m_pos]
-            op = op + 1
+            # the match is at least 0x801 bytes back, it never overlaps
+            out[op:op + 3] = out[m_pos:m_pos + 3]
+            op = op + 3
 
             state = c_match_done
             continue
@@ -138,7 +159,7 @@ def _decompress(inBuf, outBuf):
         ##
         if state == c_match:
             if t >= 64:
-                m_pos = op - 1 - ((t >> 2) & 7) - (inBuf[ip] << 3)
+                m_pos = op - 1 - ((t >> 2) & 7) - (in_buf[ip] << 3)
                 ip = ip + 1
                 t = (t >> 5) - 1
                 state = c_copy_match
@@ -146,69 +167,55 @@ def _decompress(inBuf, outBuf):
             elif t >= 32:
                 t = t & 31
                 if t == 0:
-                    while inBuf[ip] == 0:
+                    while in_buf[ip] == 0:
                         t = t + 255
                         ip = ip + 1
-                    t = t + 31 + inBuf[ip]
+                    t = t + 31 + in_buf[ip]
                     ip = ip + 1
-                m_pos = op - 1 - ((inBuf[ip] + (inBuf[ip + 1] << 8)) >> 2)
+                m_pos = op - 1 - ((in_buf[ip] + (in_buf[ip + 1] << 8)) >> 2)
                 ip = ip + 2
             elif t >= 16:
                 m_pos = op - ((t & 8) << 11)
                 t = t & 7
                 if t == 0:
-                    while inBuf[ip] == 0:
+                    while in_buf[ip] == 0:
                         t = t + 255
                         ip = ip + 1
-                    t = t + 7 + inBuf[ip]
+                    t = t + 7 + in_buf[ip]
                     ip = ip + 1
-                m_pos = m_pos - ((inBuf[ip] + (inBuf[ip + 1] << 8)) >> 2)
+                m_pos = m_pos - ((in_buf[ip] + (in_buf[ip + 1] << 8)) >> 2)
                 ip = ip + 2
                 if m_pos == op:
                     break
                 m_pos = m_pos - 0x4000
             else:
-                m_pos = op - 1 - (t >> 2) - (inBuf[ip] << 2);
+                m_pos = op - 1 - (t >> 2) - (in_buf[ip] << 2)
                 ip = ip + 1
-                out = outBuf.require(2)
-                out[op] = out[m_pos]
-                op = op + 1
-                m_pos = m_pos + 1
-                out[op] = out[m_pos]
-                op = op + 1
+                if op - m_pos >= 2:
+                    out[op:op + 2] = out[m_pos:m_pos + 2]
+                else:
+                    _copy_overlapping_match(out, op, m_pos, 2)
+                op = op + 2
                 state = c_match_done
                 continue
 
-            if t >= 6 and (op - m_pos) >= 4:
-                if_block = True
-                t += 2
-                out = outBuf.require(t)
-                while True:
-                    out[op] = out[m_pos]
-                    op += 1
-                    m_pos += 1
-                    t -= 1
-                    if not t > 0: break
             # emulate c switch
             state = c_copy_match
 
         ##
         if state == c_copy_match:
-            if not if_block:
-                t += 2
-                out = outBuf.require(t)
-                while True:
-                    out[op] = out[m_pos]
-                    op += 1
-                    m_pos += 1
-                    t -= 1
-                    if not t > 0: break
+            t += 2
+            if op - m_pos >= t:
+                out[op:op + t] = out[m_pos:m_pos + t]
+            else:
+                _copy_overlapping_match(out, op, m_pos, t)
+            op += t
             # emulating c switch
             state = c_match_done
 
         ##
         if state == c_match_done:
-            t = inBuf[ip - 2] & 3
+            t = in_buf[ip - 2] & 3
             if t == 0:
                 state = c_top_loop
                 continue
@@ -217,29 +224,31 @@ def _decompress(inBuf, outBuf):
 
         ##
         if state == c_match_next:
-            out = outBuf.require(1)
-            out[op] = inBuf[ip]
-            op += 1
-            ip += 1
-            if t > 1:
-                out = outBuf.require(1)
-                out[op] = inBuf[ip]
-                op += 1
-                ip += 1
-                if t > 2:
-                    out = outBuf.require(1)
-                    out[op] = inBuf[ip]
-                    op += 1
-                    ip += 1
-            t = inBuf[ip]
+            # 1 to 3 literals follow the match
+            out[op:op + t] = in_buf[ip:ip + t]
+            op += t
+            ip += t
+            t = in_buf[ip]
             ip += 1
             state = c_match
             continue
 
-    return bytes(outBuf.pack(op))
+    return op
 
 
 def decompress(input, initSize=16000, blockSize=8192):
-    output = FlexBuffer()
-    output.alloc(initSize, blockSize)
-    return _decompress(bytearray(input), output)
+    """
+    decompress a raw LZO1X block
+
+    :param initSize: expected size of the decompressed block, the decompressed size of MDict blocks
+    :param blockSize: kept for compatibility, the output buffer is sized by initSize
+    """
+    if _lzo1x_decompress_safe is not None:
+        block = _native_decompress(bytes(input), initSize)
+        if block is not None:
+            return block
+    out = bytearray(initSize)
+    size = _decompress(bytearray(input), out)
+    if size < len(out):
+        del out[size:]
+    return bytes(out)
@@ -6,31 +6,169 @@ import sys
 import os
 import sqlite3
 import json
+import hashlib
+import threading
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
 from aqt.utils import showInfo, showText, tooltip
 from .readmdict import MDX, MDD
+from . import compact_index
 
 # zlib compression is used for engine version >=2.0
 import zlib
 
-# LZO compression is used for engine version < 2.0
-try:
-    import lzo
-except ImportError:
-    lzo = None
-    # print("LZO compression support is not available")
+# LZO compression is used for engine version < 2.0, through liblzo2 when installed
+from . import lzo
 
 # 2x3 compatible
 if sys.hexversion >= 0x03000000:
     unicode = str
 
 version = '1.1'
+# bumped whenever the layout of the .mdx.db / .mdd.db changes, older index files are rebuilt
+INDEX_FORMAT = 2
+
+# pragmas applied to the long-lived read-only index connections
+_READ_PRAGMAS = (
+    'PRAGMA query_only = 1',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA cache_size = -16000',
+)
+# pragmas of the throwaway connection building an index, the file is discarded anyway if the build fails
+_BULK_LOAD_PRAGMAS = (
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA locking_mode = EXCLUSIVE',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -65536',
+)
+# keep "IN (?, ?, ...)" lists below the default SQLITE_MAX_VARIABLE_NUMBER (999)
+_SQL_IN_CHUNK = 900
+
+
+def file_fingerprint(fname, sample_size=64 * 1024):
+    """
+    size and md5 of the head and tail of a dictionary file, changes whenever the dictionary is replaced
+
+    :return: u"<size>:<md5 hex>"
+    """
+    size = os.path.getsize(fname)
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as f:
+        md5.update(f.read(sample_size))
+        if size > sample_size:
+            f.seek(max(size - sample_size, sample_size))
+            md5.update(f.read(sample_size))
+    return u"{}:{}".format(size, md5.hexdigest())
+
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def source_meta(fname):
+    """
+    META rows identifying the dictionary file an index is built from, see IndexBuilder.index_is_current
+    """
+    st = os.stat(fname)
+    return [('index_format', str(INDEX_FORMAT)),
+            ('source_size', str(st.st_size)),
+            ('source_mtime', repr(st.st_mtime)),
+            ('source_fingerprint', file_fingerprint(fname))]
+
+
+def _replace_file(src, dst):
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        # python 2 has no atomic replace on windows
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def mdd_basename(key_text):
+    """
+    file name part of a MDD key or of a media path referenced by a definition, lower-cased for matching
+    """
+    return key_text.replace('\\', '/').split('/')[-1].lower()
+
+
+def _synchronized(method):
+    """
+    serialize calls on one IndexBuilder, lookups may come from import worker threads
+    """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class BlockCache(object):
+    """
+    Bounded LRU cache of decompressed record blocks, keyed by (file name, file_pos).
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._blocks = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        block = self._blocks.pop(key, None)
+        if block is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # re-insert as most recently used
+        self._blocks[key] = block
+        return block
+
+    def put(self, key, block):
+        if len(block) > self.max_bytes:
+            return
+        old = self._blocks.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        self._blocks[key] = block
+        self._bytes += len(block)
+        while self._bytes > self.max_bytes:
+            _, evicted = self._blocks.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    def clear(self):
+        self._blocks.clear()
+        self._bytes = 0
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'blocks': len(self._blocks), 'bytes': self._bytes}
+
+
+class BuildCancelled(Exception):
+    """
+    raised by an index build stopped through the cancel event of IndexBuilder, the previous index is kept
+    """
 
 
 class IndexBuilder(object):
     # todo: enable history
 
     def __init__(self, fname, encoding="", passcode=None, force_rebuild=False,
-                 enable_history=False, sql_index=True, check=False):
+                 enable_history=False, sql_index=True, check=False, block_cache_size=32 * 1024 * 1024,
+                 check_workers=None, compact_index=False, cancel=None):
         self._mdx_file = fname
         self._encoding = ''
         self._stylesheet = {}
@@ -39,57 +177,122 @@ class IndexBuilder(object):
         self._description = ''
         self._sql_index = sql_index
         self._check = check
+        # threads verifying record blocks when check is set, one per core by default
+        self._check_workers = check_workers or _cpu_count()
+        # .mdx / .mdd file -> check_stats of the blocks checked by the last build, see MDict._iter_record_blocks
+        self.check_stats = {}
         self._force_rebuild = force_rebuild
+        # threading.Event stopping a running build with BuildCancelled, checked for every index row
+        self._cancel = cancel
         _filename, _file_extension = os.path.splitext(fname)
         # assert(_file_extension == '.mdx')
         # assert(os.path.isfile(fname))
         self._mdx_db = _filename + ".mdx.db"
         self._mdd_db = _filename + ".mdd.db"
         self._mdd_file = _filename + ".mdd"
+        # optional compact binary index, used for exact MDX lookups whenever it is present and up to date
+        self._mdx_idx = _filename + ".mdx.idx"
+        self._build_compact_index = compact_index
+        self._compact_index = None
+        self._compact_index_checked = False
+        # (what failed, traceback) of the errors the sqlite index recovered from, e.g. an unusable compact index
+        self.errors = []
         self.header_build_flag = False
+        # file handles and sqlite connections are kept open between lookups, see close()
+        self._file_handles = {}
+        self._connections = {}
+        self._lock = threading.RLock()
+        # decompressed record blocks shared by mdx_lookup and mdd_lookup
+        self._block_cache = BlockCache(block_cache_size)
 
-    def get_header(self):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
-        def _():
-            self.header_build_flag = True
-            mdx = MDX(self._mdx_file, only_header=True)
-            self._encoding = mdx.meta['encoding']
-            self._stylesheet = json.loads(mdx.meta['stylesheet'])
-            self._title = mdx.meta['title']
-            self._description = mdx.meta['description']
+    def _read_mdx_header(self):
+        """
+        header from the MDX itself, what the META table of its index is filled with
+        """
+        self.header_build_flag = True
+        mdx = MDX(self._mdx_file, only_header=True)
+        self._encoding = mdx.meta['encoding']
+        self._stylesheet = json.loads(mdx.meta['stylesheet'])
+        self._title = mdx.meta['title']
+        self._description = mdx.meta['description']
+        self._version = ''
 
+    def get_header(self):
         if os.path.isfile(self._mdx_db):
             # read from META table
             try:
-                conn = sqlite3.connect(self._mdx_db)
-                # cursor = conn.execute("SELECT * FROM META")
-                cursor = conn.execute(
-                    'SELECT value FROM META WHERE key IN ("encoding","stylesheet","title","description","version")')
-                self._encoding, stylesheet, \
-                self._title, self._description, self._version = (
-                    each[0] for each in cursor)
-                self._stylesheet = json.loads(stylesheet)
-                conn.close()
+                meta = self._read_meta(self._mdx_db)
+                self._encoding = meta['encoding']
+                self._stylesheet = json.loads(meta['stylesheet'])
+                self._title = meta['title']
+                self._description = meta['description']
+                self._version = meta['version']
                 if not self._version:
-                    _()
+                    self._read_mdx_header()
             except:
-                _()
+                self._read_mdx_header()
         else:
-            _()
+            self._read_mdx_header()
+
+    def _read_meta(self, db):
+        return dict(self._connect(db).execute("SELECT key, value FROM META"))
+
+    def index_is_current(self, db, source_file):
+        """
+        whether db was built from source_file as it is now by this index format.
+        Costs one stat, the partial hash of the source is only computed when its mtime changed but not its size.
+        """
+        if not os.path.isfile(db):
+            return False
+        try:
+            meta = self._read_meta(db)
+        except sqlite3.Error:
+            return False
+        if meta.get('index_format') != str(INDEX_FORMAT):
+            return False
+        st = os.stat(source_file)
+        if meta.get('source_size') != str(st.st_size):
+            return False
+        if meta.get('source_mtime') == repr(st.st_mtime):
+            return True
+        # touched but maybe not modified, e.g. restored from a backup
+        return meta.get('source_fingerprint') == file_fingerprint(source_file)
 
     def rebuild(self):
+        self.check_stats = {}
+        self._read_mdx_header()
         self._make_mdx_index()
         if os.path.isfile(self._mdd_file):
             self._make_mdd_index()
+        return self.check_stats
 
     def check_build(self):
-        self.get_header()
-        # check if the mdx.db and mdd.db file is available
-        if self.header_build_flag or not os.path.isfile(self._mdx_db):
+        """
+        rebuild the mdx.db and mdd.db files only if missing or built from another version of the dictionary
+
+        :return: {.mdx / .mdd file: check_stats} of the files rebuilt with check, see MDict._iter_record_blocks
+        """
+        self.check_stats = {}
+        if self._force_rebuild or not self.index_is_current(self._mdx_db, self._mdx_file):
+            # the META of the outdated index describes the previous file, its encoding and stylesheet may differ
+            self._read_mdx_header()
             self._make_mdx_index()
-        if os.path.isfile(self._mdd_file) and not os.path.isfile(self._mdd_db):
+        else:
+            self.get_header()
+            if self._build_compact_index and not self._get_compact_index():
+                self._make_compact_index()
+        if os.path.isfile(self._mdd_file) and (
+                self._force_rebuild or not self.index_is_current(self._mdd_db, self._mdd_file)):
             self._make_mdd_index()
+        self._force_rebuild = False
         self.header_build_flag = False
+        return self.check_stats
 
     @property
     def meta(self):
@@ -115,12 +318,52 @@ class IndexBuilder(object):
                              style[0].encode('utf-8').decode("utf-8") + p + style[1].encode('utf-8').decode("utf-8")
         return txt_styled
 
+    @contextmanager
+    def _building(self, db):
+        """
+        connection to a temp file tuned for bulk load, renamed over db once the with block succeeds.
+        A crashed build leaves the previous index untouched, the stale temp file is dropped by the next build.
+        """
+        self._disconnect(db)
+        self._block_cache.clear()
+        tmp_db = db + '.tmp'
+        if os.path.exists(tmp_db):
+            os.remove(tmp_db)
+        conn = sqlite3.connect(tmp_db)
+        try:
+            for pragma in _BULK_LOAD_PRAGMAS:
+                conn.execute(pragma)
+            yield conn
+            conn.commit()
+        except:
+            conn.close()
+            os.remove(tmp_db)
+            raise
+        conn.close()
+        _replace_file(tmp_db, db)
+
+    def _check_cancelled(self):
+        if self._cancel is not None and self._cancel.is_set():
+            raise BuildCancelled(self._mdx_file)
+
+    def _cancellable(self, rows):
+        for row in rows:
+            self._check_cancelled()
+            yield row
+
     def _make_mdx_index(self):
-        if os.path.exists(self._mdx_db):
-            os.remove(self._mdx_db)
+        self._close_compact_index()
+        self._check_cancelled()
+        source = source_meta(self._mdx_file)
         mdx = MDX(self._mdx_file, only_header=False)
-        index_list = mdx.get_index(check_block=self._check)
-        conn = sqlite3.connect(self._mdx_db)
+        index_rows = mdx.get_index(check_block=self._check, workers=self._check_workers)
+        with self._building(self._mdx_db) as conn:
+            self._fill_mdx_index(conn, self._cancellable(index_rows), source)
+        self._keep_check_stats(mdx)
+        if self._build_compact_index:
+            self._make_compact_index()
+
+    def _fill_mdx_index(self, conn, index_rows, source):
         c = conn.cursor()
         c.execute(
             ''' CREATE TABLE MDX_INDEX
@@ -135,20 +378,8 @@ class IndexBuilder(object):
                 )'''
         )
 
-        tuple_list = [
-            (item['key_text'],
-             item['file_pos'],
-             item['compressed_size'],
-             item['decompressed_size'],
-             item['record_block_type'],
-             item['record_start'],
-             item['record_end'],
-             item['offset']
-             )
-            for item in index_list
-        ]
-        c.executemany('INSERT INTO MDX_INDEX VALUES (?,?,?,?,?,?,?,?)',
-                      tuple_list)
+        # rows are streamed from the MDX file into sqlite, the index is never held in memory
+        c.executemany('INSERT INTO MDX_INDEX VALUES (?,?,?,?,?,?,?,?)', index_rows)
         # build the metadata table
         c.execute(
             '''CREATE TABLE META
@@ -162,9 +393,11 @@ class IndexBuilder(object):
              ('title', self.meta['title']),
              ('description', self.meta['description']),
              ('version', version)
-             ]
+             ] + source
         )
 
+        # the key index is created once all rows are in
+        self._check_cancelled()
         if self._sql_index:
             c.execute(
                 '''
@@ -172,19 +405,25 @@ class IndexBuilder(object):
                 '''
             )
 
-        conn.commit()
-        conn.close()
-
     def _make_mdd_index(self):
-        if os.path.exists(self._mdd_db):
-            os.remove(self._mdd_db)
+        self._check_cancelled()
+        source = source_meta(self._mdd_file)
         mdd = MDD(self._mdd_file)
-        index_list = mdd.get_index(check_block=self._check)
-        conn = sqlite3.connect(self._mdd_db)
+        index_rows = mdd.get_index(check_block=self._check, workers=self._check_workers)
+        with self._building(self._mdd_db) as conn:
+            self._fill_mdd_index(conn, self._cancellable(index_rows), source)
+        self._keep_check_stats(mdd)
+
+    def _keep_check_stats(self, mdict):
+        stats = getattr(mdict, 'check_stats', None)
+        if self._check and stats and stats['blocks']:
+            self.check_stats[mdict._fname] = stats
+
+    def _fill_mdd_index(self, conn, index_rows, source):
         c = conn.cursor()
         c.execute(
             ''' CREATE TABLE MDX_INDEX
-               (key_text text not null unique,
+               (key_text text not null,
                 file_pos integer,
                 compressed_size integer,
                 decompressed_size integer,
@@ -195,32 +434,59 @@ class IndexBuilder(object):
                 )'''
         )
 
-        tuple_list = [
-            (item['key_text'],
-             item['file_pos'],
-             item['compressed_size'],
-             item['decompressed_size'],
-             item['record_block_type'],
-             item['record_start'],
-             item['record_end'],
-             item['offset']
-             )
-            for item in index_list
-        ]
-        c.executemany('INSERT INTO MDX_INDEX VALUES (?,?,?,?,?,?,?,?)',
-                      tuple_list)
-        if self._sql_index:
-            c.execute(
-                '''
-                CREATE UNIQUE INDEX key_index ON MDX_INDEX (key_text)
-                '''
-            )
+        # rows are streamed from the MDX file into sqlite, the index is never held in memory
+        c.executemany('INSERT INTO MDX_INDEX VALUES (?,?,?,?,?,?,?,?)', index_rows)
+        # keys of a MDD are unique, the constraint is enforced once all rows are in rather than row by row
+        self._check_cancelled()
+        c.execute(
+            '''
+            CREATE UNIQUE INDEX key_index ON MDX_INDEX (key_text)
+            '''
+        )
+        self._make_mdd_basename_index(conn)
+        c.execute(
+            '''CREATE TABLE META
+               (key text,
+                value text
+                )''')
+        c.executemany('INSERT INTO META VALUES (?,?)', source)
 
-        conn.commit()
-        conn.close()
+    @staticmethod
+    def _make_mdd_basename_index(conn):
+        """
+        media file name -> MDD key, so resources are resolved by equality instead of a "LIKE '%name'" full scan
+        """
+        c = conn.cursor()
+        c.execute('DROP TABLE IF EXISTS MDD_BASENAME')
+        c.execute(
+            ''' CREATE TABLE MDD_BASENAME
+               (basename text not null,
+                key_text text not null
+                )'''
+        )
+        c.executemany('INSERT INTO MDD_BASENAME VALUES (?,?)',
+                      ((mdd_basename(row[0]), row[0]) for row in conn.execute('SELECT key_text FROM MDX_INDEX')))
+        c.execute('CREATE INDEX basename_index ON MDD_BASENAME (basename)')
+
+    @property
+    def block_cache_stats(self):
+        return self._block_cache.stats
+
+    def get_data_by_index(self, fmdx, index):
+        record_block = self._get_record_block(fmdx, index)
+        return record_block[index['record_start'] -
+                            index['offset']:index['record_end'] - index['offset']]
+
+    def _get_record_block(self, fmdx, index):
+        key = (fmdx.name, index['file_pos'])
+        record_block = self._block_cache.get(key)
+        if record_block is None:
+            record_block = self._decompress_record_block(fmdx, index)
+            self._block_cache.put(key, record_block)
+        return record_block
 
     @staticmethod
-    def get_data_by_index(fmdx, index):
+    def _decompress_record_block(fmdx, index):
         fmdx.seek(index['file_pos'])
         record_block_compressed = fmdx.read(index['compressed_size'])
         record_block_type = record_block_compressed[:4]
@@ -231,9 +497,7 @@ class IndexBuilder(object):
             _record_block = record_block_compressed[8:]
             # lzo compression
         elif record_block_type == 1:
-            if lzo is None:
-                print("LZO compression is not supported")
-                # decompress
+            # decompress
             header = b'\xf0' + pack('>I', index['decompressed_size'])
             _record_block = lzo.decompress(record_block_compressed[
                                            8:], initSize=decompressed_size, blockSize=1308672)
@@ -241,12 +505,12 @@ class IndexBuilder(object):
         elif record_block_type == 2:
             # decompress
             _record_block = zlib.decompress(record_block_compressed[8:])
-        data = _record_block[index['record_start'] -
-                             index['offset']:index['record_end'] - index['offset']]
-        return data
+        return _record_block
 
     def get_mdx_by_index(self, fmdx, index):
-        data = self.get_data_by_index(fmdx, index)
+        return self._decode_mdx_record(self.get_data_by_index(fmdx, index))
+
+    def _decode_mdx_record(self, data):
         record = data.decode(self._encoding, errors='ignore').strip(
             u'\x00').encode('utf-8')
         if self._stylesheet:
@@ -257,63 +521,216 @@ class IndexBuilder(object):
     def get_mdd_by_index(self, fmdx, index):
         return self.get_data_by_index(fmdx, index)
 
-    @staticmethod
-    def lookup_indexes(db, keyword, ignorecase=None):
+    def _connect(self, db):
+        conn = self._connections.get(db)
+        if conn is None:
+            conn = sqlite3.connect(db, check_same_thread=False)
+            for pragma in _READ_PRAGMAS:
+                conn.execute(pragma)
+            self._connections[db] = conn
+        return conn
+
+    def _disconnect(self, db):
+        conn = self._connections.pop(db, None)
+        if conn is not None:
+            conn.close()
+
+    def _close_compact_index(self):
+        if self._compact_index is not None:
+            self._compact_index.close()
+        self._compact_index = None
+        self._compact_index_checked = False
+
+    def _get_compact_index(self):
+        """
+        the compact index of the MDX if there is one built from the current MDX file, else None
+        """
+        if not self._compact_index_checked:
+            self._compact_index_checked = True
+            if os.path.isfile(self._mdx_idx):
+                try:
+                    index = compact_index.CompactIndex(self._mdx_idx)
+                except (ValueError, EnvironmentError):
+                    # truncated or of another format, sqlite is used meanwhile. Not worth reporting when
+                    # check_build is about to rebuild it
+                    if not self._build_compact_index:
+                        self._record_error(u"reading {}".format(self._mdx_idx))
+                else:
+                    if index.meta.get('source') == file_fingerprint(self._mdx_file):
+                        self._compact_index = index
+                    else:
+                        index.close()
+        return self._compact_index
+
+    def _make_compact_index(self):
+        """
+        build the compact index from the .mdx.db, see compact_index
+        """
+        self._close_compact_index()
+        self._check_cancelled()
+        tmp_idx = self._mdx_idx + '.tmp'
+        conn = sqlite3.connect(self._mdx_db)
+        try:
+            blocks = conn.execute('SELECT DISTINCT file_pos, compressed_size, decompressed_size, record_block_type, '
+                                  'offset FROM MDX_INDEX ORDER BY file_pos').fetchall()
+            rows = conn.execute('SELECT * FROM MDX_INDEX ORDER BY key_text, rowid')
+            compact_index.build(tmp_idx, blocks, self._cancellable(rows), {'source': file_fingerprint(self._mdx_file)})
+            _replace_file(tmp_idx, self._mdx_idx)
+        except (ValueError, EnvironmentError):
+            # the sqlite index stays in use
+            self._record_error(u"building {}".format(self._mdx_idx))
+        finally:
+            conn.close()
+            # left behind by a failed or cancelled build
+            if os.path.exists(tmp_idx):
+                os.remove(tmp_idx)
+
+    def _record_error(self, what):
+        tb = traceback.format_exc()
+        if isinstance(tb, bytes):
+            tb = tb.decode('utf-8', 'replace')
+        self.errors.append((what, tb))
+
+    def lookup_indexes(self, db, keyword, ignorecase=None):
+        if db == self._mdx_db and not ignorecase and self._get_compact_index():
+            return self._compact_index.lookup(keyword)
         indexes = []
         if ignorecase:
-            sql = u'SELECT * FROM MDX_INDEX WHERE lower(key_text) = lower("{}")'.format(
-                keyword)
+            sql = u'SELECT * FROM MDX_INDEX WHERE lower(key_text) = lower(?)'
         else:
-            sql = u'SELECT * FROM MDX_INDEX WHERE key_text = "{}"'.format(
-                keyword)
-        with sqlite3.connect(db) as conn:
-            cursor = conn.execute(sql)
-            for result in cursor:
-                index = {}
-                index['file_pos'] = result[1]
-                index['compressed_size'] = result[2]
-                index['decompressed_size'] = result[3]
-                index['record_block_type'] = result[4]
-                index['record_start'] = result[5]
-                index['record_end'] = result[6]
-                index['offset'] = result[7]
-                indexes.append(index)
+            sql = u'SELECT * FROM MDX_INDEX WHERE key_text = ?'
+        conn = self._connect(db)
+        cursor = conn.execute(sql, (keyword,))
+        for result in cursor:
+            indexes.append(self._row_to_index(result))
         return indexes
 
+    def lookup_indexes_many(self, db, keywords):
+        """
+        resolve all keywords in as few queries as possible
+
+        :return: list of (key_text, index) sorted by the record's position in file
+        """
+        if db == self._mdx_db and self._get_compact_index():
+            return self._compact_index.lookup_many(keywords)
+        keywords = list(set(keywords))
+        hits = []
+        conn = self._connect(db)
+        for i in range(0, len(keywords), _SQL_IN_CHUNK):
+            chunk = keywords[i:i + _SQL_IN_CHUNK]
+            sql = u'SELECT * FROM MDX_INDEX WHERE key_text IN ({})'.format(','.join('?' * len(chunk)))
+            for result in conn.execute(sql, chunk):
+                hits.append((result[0], self._row_to_index(result)))
+        hits.sort(key=lambda hit: (hit[1]['file_pos'], hit[1]['record_start']))
+        return hits
+
+    @staticmethod
+    def _row_to_index(result):
+        index = {}
+        index['file_pos'] = result[1]
+        index['compressed_size'] = result[2]
+        index['decompressed_size'] = result[3]
+        index['record_block_type'] = result[4]
+        index['record_start'] = result[5]
+        index['record_end'] = result[6]
+        index['offset'] = result[7]
+        return index
+
+    def _open_file(self, fname):
+        f = self._file_handles.get(fname)
+        if f is None or f.closed:
+            f = open(fname, 'rb')
+            self._file_handles[fname] = f
+        return f
+
+    @_synchronized
+    def close(self):
+        for f in self._file_handles.values():
+            f.close()
+        self._file_handles = {}
+        for conn in self._connections.values():
+            conn.close()
+        self._connections = {}
+        self._close_compact_index()
+        self._block_cache.clear()
+
+    @_synchronized
     def mdx_lookup(self, keyword, ignorecase=None):
         lookup_result_list = []
         indexes = self.lookup_indexes(self._mdx_db, keyword, ignorecase)
-        with open(self._mdx_file, 'rb') as mdx_file:
+        if indexes:
+            mdx_file = self._open_file(self._mdx_file)
             for index in indexes:
                 lookup_result_list.append(
                     self.get_mdx_by_index(mdx_file, index))
         return lookup_result_list
 
+    @_synchronized
+    def mdx_lookup_many(self, keywords):
+        """
+        look up many words with one sequential pass over the MDX file, every record block is decompressed once
+
+        :return: {keyword: [record, ...]} for the keywords found in the dictionary
+        """
+        lookup_results = {}
+        hits = self.lookup_indexes_many(self._mdx_db, keywords)
+        if hits:
+            mdx_file = self._open_file(self._mdx_file)
+            block_pos, record_block = None, None
+            for key_text, index in hits:
+                if index['file_pos'] != block_pos:
+                    block_pos = index['file_pos']
+                    record_block = self._get_record_block(mdx_file, index)
+                data = record_block[index['record_start'] -
+                                    index['offset']:index['record_end'] - index['offset']]
+                lookup_results.setdefault(key_text, []).append(self._decode_mdx_record(data))
+        return lookup_results
+
+    @_synchronized
     def mdd_lookup(self, keyword, ignorecase=None):
         lookup_result_list = []
         indexes = self.lookup_indexes(self._mdd_db, keyword, ignorecase)
-        with open(self._mdd_file, 'rb') as mdd_file:
+        if indexes:
+            mdd_file = self._open_file(self._mdd_file)
             for index in indexes:
                 lookup_result_list.append(
                     self.get_mdd_by_index(mdd_file, index))
         return lookup_result_list
 
-    @staticmethod
-    def get_keys(db, query=''):
+    @_synchronized
+    def get_keys(self, db, query=''):
         if not db:
             return []
+        conn = self._connect(db)
         if query:
             if '*' in query:
                 query = query.replace('*', '%')
             else:
                 query = query + '%'
-            sql = 'SELECT key_text FROM MDX_INDEX WHERE key_text LIKE \"' + query + '\"'
+            cursor = conn.execute('SELECT key_text FROM MDX_INDEX WHERE key_text LIKE ?', (query,))
         else:
-            sql = 'SELECT key_text FROM MDX_INDEX'
-        with sqlite3.connect(db) as conn:
-            cursor = conn.execute(sql)
-            keys = [item[0] for item in cursor]
-            return keys
+            cursor = conn.execute('SELECT key_text FROM MDX_INDEX')
+        return [item[0] for item in cursor]
+
+    @_synchronized
+    def mdd_keys_by_basename(self, basenames):
+        """
+        resolve media file names to MDD keys with the basename index
+
+        :return: {basename: [key_text, ...]} for the file names found in the MDD, names are lower-cased
+        """
+        if not os.path.isfile(self._mdd_db):
+            return {}
+        basenames = list(set(mdd_basename(b) for b in basenames))
+        keys = {}
+        conn = self._connect(self._mdd_db)
+        for i in range(0, len(basenames), _SQL_IN_CHUNK):
+            chunk = basenames[i:i + _SQL_IN_CHUNK]
+            sql = u'SELECT basename, key_text FROM MDD_BASENAME WHERE basename IN ({})'.format(
+                ','.join('?' * len(chunk)))
+            for basename, key_text in conn.execute(sql, chunk):
+                keys.setdefault(basename, []).append(key_text)
+        return keys
 
     def get_mdd_keys(self, query=''):
         try:
@@ -249,25 +249,104 @@ class Salsa20(object):
         assert type(data) == bytes, 'data must be byte string'
         assert self._lastChunk64, 'previous chunk not multiple of 64 bytes'
         lendata = len(data)
-        munged = bytearray(lendata)
+        state = [w & 0xffffffff for w in self.ctx]
+        counter = self.getCounter()
+        blocks = []
         for i in range(0, lendata, 64):
-            h = salsa20_wordtobyte(self.ctx, self.rounds, checkRounds=False)
-            self.setCounter((self.getCounter() + 1) % 2 ** 64)
+            state[8] = counter & 0xffffffff
+            state[9] = counter >> 32
+            blocks.append(_keystream_block(state, self.rounds))
             # Stopping at 2^70 bytes per nonce is user's responsibility.
-            for j in range(min(64, lendata - i)):
-                if python3:
-                    munged[i + j] = data[i + j] ^ h[j]
-                else:
-                    munged[i + j] = ord(data[i + j]) ^ ord(h[j])
-
+            counter = (counter + 1) % 2 ** 64
+        self.setCounter(counter)
         self._lastChunk64 = not lendata % 64
-        return bytes(munged)
+        return _xor_bytes(data, b''.join(blocks)[:lendata])
 
     decryptBytes = encryptBytes  # encrypt and decrypt use same function
 
 
+# ------------------------- keystream cache --------------------------------
+# MDict decrypts the same few bytes with the same key every time a dictionary is opened, keystream blocks are
+# cached by (state, rounds), the cache is emptied when full
+
+_KEYSTREAM_CACHE_SIZE = 1024
+_keystream_cache = {}
+
+
+def _keystream_block(state, nRounds):
+    """ state: 16 unsigned ints, returns the 64-byte keystream block """
+    key = (tuple(state), nRounds)
+    block = _keystream_cache.get(key)
+    if block is None:
+        block = _salsa20_core(state, nRounds)
+        if len(_keystream_cache) >= _KEYSTREAM_CACHE_SIZE:
+            _keystream_cache.clear()
+        _keystream_cache[key] = block
+    return block
+
+
+if python3:
+    def _xor_bytes(data, keystream):
+        n = len(data)
+        return (int.from_bytes(data, 'little') ^ int.from_bytes(keystream, 'little')).to_bytes(n, 'little')
+else:
+    def _xor_bytes(data, keystream):
+        return bytes(bytearray(a ^ b for a, b in zip(bytearray(data), bytearray(keystream))))
+
+
 # --------------------------------------------------------------------------
 
+little16_u32 = Struct("<16I")  # 16 little-endian 32-bit unsigned ints.
+
+
+def _salsa20_core(input, nRounds):
+    """ Salsa20 core on 16 unsigned ints, with the additions and rotations inlined.
+        Returns a 64-byte string, the same as salsa20_wordtobyte.
+        """
+    (x0, x1, x2, x3, x4, x5, x6, x7, x8, x9, x10, x11, x12, x13, x14, x15) = input
+    M = 0xffffffff
+    for i in range(nRounds // 2):
+        t = (x0 + x12) & M; x4 ^= ((t << 7) & M) | (t >> 25)
+        t = (x4 + x0) & M; x8 ^= ((t << 9) & M) | (t >> 23)
+        t = (x8 + x4) & M; x12 ^= ((t << 13) & M) | (t >> 19)
+        t = (x12 + x8) & M; x0 ^= ((t << 18) & M) | (t >> 14)
+        t = (x5 + x1) & M; x9 ^= ((t << 7) & M) | (t >> 25)
+        t = (x9 + x5) & M; x13 ^= ((t << 9) & M) | (t >> 23)
+        t = (x13 + x9) & M; x1 ^= ((t << 13) & M) | (t >> 19)
+        t = (x1 + x13) & M; x5 ^= ((t << 18) & M) | (t >> 14)
+        t = (x10 + x6) & M; x14 ^= ((t << 7) & M) | (t >> 25)
+        t = (x14 + x10) & M; x2 ^= ((t << 9) & M) | (t >> 23)
+        t = (x2 + x14) & M; x6 ^= ((t << 13) & M) | (t >> 19)
+        t = (x6 + x2) & M; x10 ^= ((t << 18) & M) | (t >> 14)
+        t = (x15 + x11) & M; x3 ^= ((t << 7) & M) | (t >> 25)
+        t = (x3 + x15) & M; x7 ^= ((t << 9) & M) | (t >> 23)
+        t = (x7 + x3) & M; x11 ^= ((t << 13) & M) | (t >> 19)
+        t = (x11 + x7) & M; x15 ^= ((t << 18) & M) | (t >> 14)
+
+        t = (x0 + x3) & M; x1 ^= ((t << 7) & M) | (t >> 25)
+        t = (x1 + x0) & M; x2 ^= ((t << 9) & M) | (t >> 23)
+        t = (x2 + x1) & M; x3 ^= ((t << 13) & M) | (t >> 19)
+        t = (x3 + x2) & M; x0 ^= ((t << 18) & M) | (t >> 14)
+        t = (x5 + x4) & M; x6 ^= ((t << 7) & M) | (t >> 25)
+        t = (x6 + x5) & M; x7 ^= ((t << 9) & M) | (t >> 23)
+        t = (x7 + x6) & M; x4 ^= ((t << 13) & M) | (t >> 19)
+        t = (x4 + x7) & M; x5 ^= ((t << 18) & M) | (t >> 14)
+        t = (x10 + x9) & M; x11 ^= ((t << 7) & M) | (t >> 25)
+        t = (x11 + x10) & M; x8 ^= ((t << 9) & M) | (t >> 23)
+        t = (x8 + x11) & M; x9 ^= ((t << 13) & M) | (t >> 19)
+        t = (x9 + x8) & M; x10 ^= ((t << 18) & M) | (t >> 14)
+        t = (x15 + x14) & M; x12 ^= ((t << 7) & M) | (t >> 25)
+        t = (x12 + x15) & M; x13 ^= ((t << 9) & M) | (t >> 23)
+        t = (x13 + x12) & M; x14 ^= ((t << 13) & M) | (t >> 19)
+        t = (x14 + x13) & M; x15 ^= ((t << 18) & M) | (t >> 14)
+
+    return little16_u32.pack(
+        (x0 + input[0]) & M, (x1 + input[1]) & M, (x2 + input[2]) & M, (x3 + input[3]) & M,
+        (x4 + input[4]) & M, (x5 + input[5]) & M, (x6 + input[6]) & M, (x7 + input[7]) & M,
+        (x8 + input[8]) & M, (x9 + input[9]) & M, (x10 + input[10]) & M, (x11 + input[11]) & M,
+        (x12 + input[12]) & M, (x13 + input[13]) & M, (x14 + input[14]) & M, (x15 + input[15]) & M)
+
+
 def salsa20_wordtobyte(input, nRounds=20, checkRounds=True):
     """ Do nRounds Salsa20 rounds on a copy of 
             input: list or tuple of 16 ints treated as little-endian unsigneds.
@@ -277,54 +356,7 @@ def salsa20_wordtobyte(input, nRounds=20, checkRounds=True):
     assert (type(input) in (list, tuple) and len(input) == 16)
     assert (not (checkRounds) or (nRounds in [8, 12, 20]))
 
-    x = list(input)
-
-    def XOR(a, b):
-        return a ^ b
-
-    ROTATE = rot32
-    PLUS = add32
-
-    for i in range(nRounds // 2):
-        # These ...XOR...ROTATE...PLUS... lines are from ecrypt-linux.c
-        # unchanged except for indents and the blank line between rounds:
-        x[4] = XOR(x[4], ROTATE(PLUS(x[0], x[12]), 7));
-        x[8] = XOR(x[8], ROTATE(PLUS(x[4], x[0]), 9));
-        x[12] = XOR(x[12], ROTATE(PLUS(x[8], x[4]), 13));
-        x[0] = XOR(x[0], ROTATE(PLUS(x[12], x[8]), 18));
-        x[9] = XOR(x[9], ROTATE(PLUS(x[5], x[1]), 7));
-        x[13] = XOR(x[13], ROTATE(PLUS(x[9], x[5]), 9));
-        x[1] = XOR(x[1], ROTATE(PLUS(x[13], x[9]), 13));
-        x[5] = XOR(x[5], ROTATE(PLUS(x[1], x[13]), 18));
-        x[14] = XOR(x[14], ROTATE(PLUS(x[10], x[6]), 7));
-        x[2] = XOR(x[2], ROTATE(PLUS(x[14], x[10]), 9));
-        x[6] = XOR(x[6], ROTATE(PLUS(x[2], x[14]), 13));
-        x[10] = XOR(x[10], ROTATE(PLUS(x[6], x[2]), 18));
-        x[3] = XOR(x[3], ROTATE(PLUS(x[15], x[11]), 7));
-        x[7] = XOR(x[7], ROTATE(PLUS(x[3], x[15]), 9));
-        x[11] = XOR(x[11], ROTATE(PLUS(x[7], x[3]), 13));
-        x[15] = XOR(x[15], ROTATE(PLUS(x[11], x[7]), 18));
-
-        x[1] = XOR(x[1], ROTATE(PLUS(x[0], x[3]), 7));
-        x[2] = XOR(x[2], ROTATE(PLUS(x[1], x[0]), 9));
-        x[3] = XOR(x[3], ROTATE(PLUS(x[2], x[1]), 13));
-        x[0] = XOR(x[0], ROTATE(PLUS(x[3], x[2]), 18));
-        x[6] = XOR(x[6], ROTATE(PLUS(x[5], x[4]), 7));
-        x[7] = XOR(x[7], ROTATE(PLUS(x[6], x[5]), 9));
-        x[4] = XOR(x[4], ROTATE(PLUS(x[7], x[6]), 13));
-        x[5] = XOR(x[5], ROTATE(PLUS(x[4], x[7]), 18));
-        x[11] = XOR(x[11], ROTATE(PLUS(x[10], x[9]), 7));
-        x[8] = XOR(x[8], ROTATE(PLUS(x[11], x[10]), 9));
-        x[9] = XOR(x[9], ROTATE(PLUS(x[8], x[11]), 13));
-        x[10] = XOR(x[10], ROTATE(PLUS(x[9], x[8]), 18));
-        x[12] = XOR(x[12], ROTATE(PLUS(x[15], x[14]), 7));
-        x[13] = XOR(x[13], ROTATE(PLUS(x[12], x[15]), 9));
-        x[14] = XOR(x[14], ROTATE(PLUS(x[13], x[12]), 13));
-        x[15] = XOR(x[15], ROTATE(PLUS(x[14], x[13]), 18));
-
-    for i in range(len(input)):
-        x[i] = PLUS(x[i], input[i])
-    return little16_i32.pack(*x)
+    return _salsa20_core([w & 0xffffffff for w in input], nRounds)
 
 
 # --------------------------- 32-bit ops -------------------------------
@@ -17,11 +17,13 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
 # GNU General Public License for more details.
 
-from struct import pack, unpack
+from struct import pack, unpack, Struct
 from io import BytesIO
+from array import array
 import re
 import sys
 import json
+import time
 
 from .ripemd128 import ripemd128
 from .pureSalsa20 import Salsa20
@@ -30,17 +32,65 @@ from aqt.utils import showInfo, showText, tooltip
 # zlib compression is used for engine version >=2.0
 import zlib
 
-# LZO compression is used for engine version < 2.0
-try:
-    import lzo
-except ImportError:
-    lzo = None
-    print("LZO compression support is not available")
+# LZO compression is used for engine version < 2.0, through liblzo2 when installed
+from . import lzo
 
 # 2x3 compatible
 if sys.hexversion >= 0x03000000:
     unicode = str
 
+# columns of the tuples yielded by MDict.get_index / MDX.get_index, also the column order of the MDX_INDEX table
+INDEX_FIELDS = ('key_text', 'file_pos', 'compressed_size', 'decompressed_size',
+                'record_block_type', 'record_start', 'record_end', 'offset')
+
+
+try:
+    array('Q')
+    _OFFSET_TYPECODE = 'Q'
+except ValueError:
+    # python 2 has no unsigned long long arrays
+    _OFFSET_TYPECODE = 'L'
+
+
+class KeyList(object):
+    """
+    Keys of a MDict, sequence of (record_start, key) like the list of tuples it replaces.
+
+    Record offsets are kept in an array, the keys in a single buffer with an array of their end offsets,
+    a few bytes per key instead of a tuple, an int and a bytes object each.
+    """
+
+    def __init__(self):
+        self.record_starts = array(_OFFSET_TYPECODE)
+        self._key_ends = array(_OFFSET_TYPECODE)
+        self._keys = bytearray()
+
+    def extend(self, key_list):
+        for record_start, key_text in key_list:
+            self.record_starts.append(record_start)
+            self._keys += key_text
+            self._key_ends.append(len(self._keys))
+
+    def key(self, i):
+        start = self._key_ends[i - 1] if i > 0 else 0
+        return bytes(self._keys[start:self._key_ends[i]])
+
+    def __len__(self):
+        return len(self.record_starts)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("key index out of range")
+        return self.record_starts[i], self.key(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.record_starts[i], self.key(i)
+
 
 def _unescape_entities(text):
     """
@@ -53,16 +103,71 @@ def _unescape_entities(text):
     return text
 
 
+# byte with its two nibbles swapped, for bytes.translate
+_NIBBLE_SWAP = bytes(bytearray(((i >> 4) | (i << 4)) & 0xff for i in range(256)))
+# (i & 0xff) for i in range(256)
+_BYTE_INDEXES = bytes(bytearray(range(256)))
+
+if sys.hexversion >= 0x03000000:
+    def _xor_bytes(*streams):
+        """
+        xor byte strings of the same length
+        """
+        n = len(streams[0])
+        x = 0
+        for stream in streams:
+            x ^= int.from_bytes(stream, 'little')
+        return x.to_bytes(n, 'little')
+else:
+    def _xor_bytes(*streams):
+        """
+        xor byte strings of the same length
+        """
+        out = bytearray(streams[0])
+        for stream in streams[1:]:
+            for i, c in enumerate(bytearray(stream)):
+                out[i] ^= c
+        return bytes(out)
+
+
+def _repeat_to(pattern, n):
+    return (pattern * (n // len(pattern) + 1))[:n]
+
+
 def _fast_decrypt(data, key):
-    b = bytearray(data)
-    key = bytearray(key)
-    previous = 0x36
-    for i in range(len(b)):
-        t = (b[i] >> 4 | b[i] << 4) & 0xff
-        t = t ^ previous ^ (i & 0xff) ^ key[i % len(key)]
-        previous = b[i]
-        b[i] = t
-    return bytes(b)
+    """
+    every byte has its nibbles swapped, then is xored with the previous encrypted byte (0x36 for the first one),
+    its index and the key
+    """
+    data = bytes(data)
+    n = len(data)
+    if not n:
+        return b''
+    return _xor_bytes(data.translate(_NIBBLE_SWAP), b'\x36' + data[:-1],
+                      _repeat_to(_BYTE_INDEXES, n), _repeat_to(bytes(key), n))
+
+
+def _check_record_block(block):
+    """
+    decompress a record block and verify its adler32 checksum and size
+
+    :param block: (record_block_compressed, decompressed_size)
+    """
+    record_block_compressed, decompressed_size = block
+    # 4 bytes: compression type
+    record_block_type = record_block_compressed[:4]
+    # 4 bytes: adler32 checksum of decompressed record block
+    adler32 = unpack('>I', record_block_compressed[4:8])[0]
+    if record_block_type == b'\x00\x00\x00\x00':
+        record_block = record_block_compressed[8:]
+    elif record_block_type == b'\x01\x00\x00\x00':
+        record_block = lzo.decompress(record_block_compressed[8:],
+                                      initSize=decompressed_size, blockSize=1308672)
+    elif record_block_type == b'\x02\x00\x00\x00':
+        record_block = zlib.decompress(record_block_compressed[8:])
+    # notice that adler32 return signed value
+    assert (adler32 == zlib.adler32(record_block) & 0xffffffff)
+    assert (len(record_block) == decompressed_size)
 
 
 def _mdx_decrypt(comp_block):
@@ -202,7 +307,7 @@ class MDict(object):
         return key_block_info_list
 
     def _decode_key_block(self, key_block_compressed, key_block_info_list):
-        key_list = []
+        key_list = KeyList()
         i = 0
         for compressed_size, decompressed_size in key_block_info_list:
             start = i
@@ -215,9 +320,6 @@ class MDict(object):
             if key_block_type == b'\x00\x00\x00\x00':
                 key_block = key_block_compressed[start + 8:end]
             elif key_block_type == b'\x01\x00\x00\x00':
-                if lzo is None:
-                    print("LZO compression is not supported")
-                    break
                 # decompress key block
                 header = b'\xf0' + pack('>I', decompressed_size)
                 key_block = lzo.decompress(key_block_compressed[
@@ -227,7 +329,7 @@ class MDict(object):
                 key_block = zlib.decompress(
                     key_block_compressed[start + 8:end])
             # extract one single key block into a key list
-            key_list += self._split_key_block(key_block)
+            key_list.extend(self._split_key_block(key_block))
             # notice that adler32 returns signed value
             assert (adler32 == zlib.adler32(key_block) & 0xffffffff)
 
@@ -235,6 +337,47 @@ class MDict(object):
         return key_list
 
     def _split_key_block(self, key_block):
+        """
+        (record_start, utf-8 key) of every key in a decompressed key block
+        """
+        try:
+            return self._split_key_block_fast(key_block)
+        except Exception:
+            return self._split_key_block_slow(key_block)
+
+    def _split_key_block_fast(self, key_block):
+        # keys are located with bytes.find instead of comparing the block byte by byte
+        if self._encoding == 'UTF-16':
+            delimiter = b'\x00\x00'
+            width = 2
+        else:
+            delimiter = b'\x00'
+            width = 1
+        encoding = self._encoding
+        number_width = self._number_width
+        unpack_number = Struct(self._number_format).unpack_from
+        find = key_block.find
+        block_size = len(key_block)
+        key_list = []
+        append = key_list.append
+        key_start_index = 0
+        while key_start_index < block_size:
+            # the corresponding record's offset in record block
+            key_id = unpack_number(key_block, key_start_index)[0]
+            text_start = key_start_index + number_width
+            # key text ends with '\x00', a UTF-16 terminator must start on a character boundary
+            key_end_index = find(delimiter, text_start)
+            while width == 2 and key_end_index != -1 and (key_end_index - text_start) % 2:
+                key_end_index = find(delimiter, key_end_index + 1)
+            if key_end_index == -1:
+                raise ValueError("unterminated key in key block")
+            key_text = key_block[text_start:key_end_index] \
+                .decode(encoding, errors='ignore').encode('utf-8').strip()
+            key_start_index = key_end_index + width
+            append((key_id, key_text))
+        return key_list
+
+    def _split_key_block_slow(self, key_block):
         key_list = []
         key_start_index = 0
         while key_start_index < len(key_block):
@@ -444,6 +587,76 @@ class MDict(object):
         self._num_entries = len(key_list)
         return key_list
 
+    def _iter_record_blocks(self, f, record_block_info_list, check_block=True, workers=1):
+        """
+        yield (file_pos, compressed_size, decompressed_size, record_block_type) of every record block.
+
+        With check_block every block is decompressed and verified, by a pool of ``workers`` threads when more
+        than one: zlib and liblzo2 release the GIL, so the blocks are checked on several cores while the file is
+        read on. The pool is only started by the first such block, blocks decoded by the pure Python LZO are
+        checked serially. ``self.check_stats`` counts the blocks and compressed bytes checked, with the seconds
+        spent decompressing and verifying them, reading the file and the caller's work are not timed.
+        """
+        pool = None
+        parallel = check_block and workers > 1
+        # blocks read ahead and checked together by the pool, bounds the memory held by the check
+        window_size = 1
+        window = []
+        self.check_stats = {'blocks': 0, 'bytes': 0, 'seconds': 0.0, 'workers': 1}
+        try:
+            for compressed_size, decompressed_size in record_block_info_list:
+                current_pos = f.tell()
+                if check_block:
+                    record_block_compressed = f.read(compressed_size)
+                else:
+                    # only the block header is needed to index the block
+                    record_block_compressed = f.read(8)
+                    f.seek(current_pos + compressed_size)
+                # 4 bytes: compression type
+                record_block_type = record_block_compressed[:4]
+                if record_block_type == b'\x00\x00\x00\x00':
+                    _type = 0
+                elif record_block_type == b'\x01\x00\x00\x00':
+                    _type = 1
+                elif record_block_type == b'\x02\x00\x00\x00':
+                    _type = 2
+                if parallel and pool is None and (_type == 2 or _type == 1 and lzo.releases_gil):
+                    parallel = False
+                    pool = self._start_pool(workers)
+                    if pool:
+                        window_size = workers * 4
+                        self.check_stats['workers'] = workers
+                if check_block:
+                    window.append((record_block_compressed, decompressed_size))
+                    self.check_stats['blocks'] += 1
+                    self.check_stats['bytes'] += compressed_size
+                    if len(window) >= window_size:
+                        self._check_record_blocks(pool, window)
+                        window = []
+                yield current_pos, compressed_size, decompressed_size, _type
+            if window:
+                self._check_record_blocks(pool, window)
+        finally:
+            if pool:
+                pool.terminate()
+
+    @staticmethod
+    def _start_pool(workers):
+        try:
+            from multiprocessing.pool import ThreadPool
+            return ThreadPool(workers)
+        except (ImportError, OSError):
+            return None
+
+    def _check_record_blocks(self, pool, blocks):
+        start = time.time()
+        if pool:
+            pool.map(_check_record_block, blocks)
+        else:
+            for block in blocks:
+                _check_record_block(block)
+        self.check_stats['seconds'] += time.time() - start
+
 
 class MDD(MDict):
     """
@@ -496,13 +709,10 @@ class MDD(MDict):
             if record_block_type == b'\x00\x00\x00\x00':
                 record_block = record_block_compressed[8:]
             elif record_block_type == b'\x01\x00\x00\x00':
-                if lzo is None:
-                    print("LZO compression is not supported")
-                    break
                 # decompress
                 header = b'\xf0' + pack('>I', decompressed_size)
                 record_block = lzo.decompress(record_block_compressed[
-                                              start + 8:end], initSize=decompressed_size, blockSize=1308672)
+                                              8:], initSize=decompressed_size, blockSize=1308672)
             elif record_block_type == b'\x02\x00\x00\x00':
                 # decompress
                 record_block = zlib.decompress(record_block_compressed[8:])
@@ -541,9 +751,12 @@ class MDD(MDict):
         # record_end
         # offset
 
-    def get_index(self, check_block=True):
+    def get_index(self, check_block=True, workers=1):
+        """
+        yield the index entries one by one as tuples in the order of INDEX_FIELDS, the whole index is never held
+        in memory. Record blocks are only read and verified when check_block is set, see _iter_record_blocks.
+        """
         f = open(self._fname, 'rb')
-        index_dict_list = []
         f.seek(self._record_block_offset)
 
         num_record_blocks = self._read_number(f)
@@ -567,70 +780,29 @@ class MDD(MDict):
         offset = 0
         i = 0
         size_counter = 0
-        for compressed_size, decompressed_size in record_block_info_list:
-            current_pos = f.tell()
-            record_block_compressed = f.read(compressed_size)
-            # 4 bytes: compression type
-            record_block_type = record_block_compressed[:4]
-            # 4 bytes: adler32 checksum of decompressed record block
-            adler32 = unpack('>I', record_block_compressed[4:8])[0]
-            if record_block_type == b'\x00\x00\x00\x00':
-                _type = 0
-                if check_block:
-                    record_block = record_block_compressed[8:]
-            elif record_block_type == b'\x01\x00\x00\x00':
-                _type = 1
-                if lzo is None:
-                    print("LZO compression is not supported")
-                    break
-                # decompress
-                header = b'\xf0' + pack('>I', decompressed_size)
-                if check_block:
-                    record_block = lzo.decompress(record_block_compressed[
-                                                  start + 8:end], initSize=decompressed_size, blockSize=1308672)
-            elif record_block_type == b'\x02\x00\x00\x00':
-                # decompress
-                _type = 2
-                if check_block:
-                    record_block = zlib.decompress(record_block_compressed[8:])
-
-            # notice that adler32 return signed value
-            if check_block:
-                assert (adler32 == zlib.adler32(record_block) & 0xffffffff)
-                assert (len(record_block) == decompressed_size)
+        num_keys = len(self._key_list)
+        record_starts = self._key_list.record_starts
+        for current_pos, compressed_size, decompressed_size, _type in self._iter_record_blocks(
+                f, record_block_info_list, check_block, workers):
             # split record block according to the offset info from key block
-            while i < len(self._key_list):
-                # 用来保存索引信息的空字典
-                index_dict = {}
-                index_dict['file_pos'] = current_pos
-                index_dict['compressed_size'] = compressed_size
-                index_dict['decompressed_size'] = decompressed_size
-                index_dict['record_block_type'] = _type
-                record_start, key_text = self._key_list[i]
-                index_dict['record_start'] = record_start
-                index_dict['key_text'] = key_text.decode(
-                    "utf-8", errors='ignore')
-                index_dict['offset'] = offset
+            while i < num_keys:
+                record_start = record_starts[i]
                 # reach the end of current record block
                 if record_start - offset >= decompressed_size:
                     break
                 # record end index
-                if i < len(self._key_list) - 1:
-                    record_end = self._key_list[i + 1][0]
+                if i < num_keys - 1:
+                    record_end = record_starts[i + 1]
                 else:
                     record_end = decompressed_size + offset
-                index_dict['record_end'] = record_end
+                key_text = self._key_list.key(i)
                 i += 1
-                if check_block:
-                    data = record_block[
-                           record_start - offset:record_end - offset]
-                index_dict_list.append(index_dict)
-                # yield key_text, data
+                yield (key_text.decode("utf-8", errors='ignore'), current_pos, compressed_size, decompressed_size,
+                       _type, record_start, record_end, offset)
             offset += decompressed_size
             size_counter += compressed_size
         assert (size_counter == record_block_size)
         f.close()
-        return index_dict_list
 
 
 class MDX(MDict):
@@ -713,9 +885,6 @@ class MDX(MDict):
                 record_block = record_block_compressed[8:]
             # lzo compression
             elif record_block_type == b'\x01\x00\x00\x00':
-                if lzo is None:
-                    print("LZO compression is not supported")
-                    break
                 # decompress
                 header = b'\xf0' + pack('>I', decompressed_size)
                 record_block = lzo.decompress(record_block_compressed[
@@ -774,9 +943,11 @@ class MDX(MDict):
     # offset
     # 所需 metadata
     ###
-    def get_index(self, check_block=True):
-        # 索引列表
-        index_dict_list = []
+    def get_index(self, check_block=True, workers=1):
+        """
+        yield the index entries one by one as tuples in the order of INDEX_FIELDS, the whole index is never held
+        in memory. Record blocks are only read and verified when check_block is set, see _iter_record_blocks.
+        """
         f = open(self._fname, 'rb')
         f.seek(self._record_block_offset)
 
@@ -800,97 +971,33 @@ class MDX(MDict):
         offset = 0
         i = 0
         size_counter = 0
-        # 最后的索引表的格式为
-        # key_text(关键词，可以由后面的 keylist 得到)
-        # file_pos(record_block开始的位置)
-        # compressed_size(record_block压缩前的大小)
-        # decompressed_size(解压后的大小)
-        # record_block_type(record_block 的压缩类型)
-        # record_start (以下三个为从 record_block 中提取某一调记录需要的参数，可以直接保存）
-        # record_end
-        # offset
-        for compressed_size, decompressed_size in record_block_info_list:
-            current_pos = f.tell()
-            record_block_compressed = f.read(compressed_size)
-            # 要得到 record_block_compressed 需要得到 compressed_size (这个可以直接记录）
-            # 另外还需要记录当前 f 对象的位置
-            # 使用 f.tell() 命令/ 在建立索引是需要 f.seek()
-            # 4 bytes indicates block compression type
-            record_block_type = record_block_compressed[:4]
-            # 4 bytes adler checksum of uncompressed content
-            adler32 = unpack('>I', record_block_compressed[4:8])[0]
-            # no compression
-            if record_block_type == b'\x00\x00\x00\x00':
-                _type = 0
-                record_block = record_block_compressed[8:]
-            # lzo compression
-            elif record_block_type == b'\x01\x00\x00\x00':
-                _type = 1
-                if lzo is None:
-                    print("LZO compression is not supported")
-                    break
-                # decompress
-                header = b'\xf0' + pack('>I', decompressed_size)
-                if check_block:
-                    record_block = lzo.decompress(record_block_compressed[
-                                                  8:], initSize=decompressed_size, blockSize=1308672)
-            # zlib compression
-            elif record_block_type == b'\x02\x00\x00\x00':
-                # decompress
-                _type = 2
-                if check_block:
-                    record_block = zlib.decompress(record_block_compressed[8:])
-            # 这里比较重要的是先要得到 record_block, 而 record_block 是解压得到的，其中一共有三种解压方法
-            # 需要的信息有 record_block_compressed, decompress_size,
-            # record_block_type
-            # 另外还需要校验信息 adler32
-            # notice that adler32 return signed value
-            if check_block:
-                assert (adler32 == zlib.adler32(record_block) & 0xffffffff)
-                assert (len(record_block) == decompressed_size)
+        num_keys = len(self._key_list)
+        record_starts = self._key_list.record_starts
+        # 要得到 record_block_compressed 需要得到 compressed_size (这个可以直接记录）
+        # 另外还需要记录当前 f 对象的位置
+        for current_pos, compressed_size, decompressed_size, _type in self._iter_record_blocks(
+                f, record_block_info_list, check_block, workers):
             # split record block according to the offset info from key block
-            while i < len(self._key_list):
-                # 用来保存索引信息的空字典
-                index_dict = {}
-                index_dict['file_pos'] = current_pos
-                index_dict['compressed_size'] = compressed_size
-                index_dict['decompressed_size'] = decompressed_size
-                index_dict['record_block_type'] = _type
-                record_start, key_text = self._key_list[i]
-                index_dict['record_start'] = record_start
-                index_dict['key_text'] = key_text.decode(
-                    'utf-8', errors='ignore')
-                index_dict['offset'] = offset
+            while i < num_keys:
+                record_start = record_starts[i]
                 # reach the end of current record block
                 if record_start - offset >= decompressed_size:
                     break
                 # record end index
-                if i < len(self._key_list) - 1:
-                    record_end = self._key_list[i + 1][0]
+                if i < num_keys - 1:
+                    record_end = record_starts[i + 1]
                 else:
                     record_end = decompressed_size + offset
-                index_dict['record_end'] = record_end
+                key_text = self._key_list.key(i)
                 i += 1
-                # 需要得到 record_block , record_start, record_end,
-                # offset
-                if check_block:
-                    record = record_block[
-                             record_start - offset:record_end - offset]
-                    # convert to utf-8
-                    record = record.decode(self._encoding, errors='ignore').strip(
-                        u'\x00').encode('utf-8')
-                    # substitute styles
-                    # 是否替换样式表
-                    if self._substyle and self._stylesheet:
-                        record = self._substitute_stylesheet(record)
-                index_dict_list.append(index_dict)
+                yield (key_text.decode('utf-8', errors='ignore'), current_pos, compressed_size, decompressed_size,
+                       _type, record_start, record_end, offset)
 
             offset += decompressed_size
             size_counter += compressed_size
         # todo: 注意！！！
         # assert(size_counter == record_block_size)
-        f.close
-        return index_dict_list
+        f.close()
 
 
 if __name__ == '__main__':
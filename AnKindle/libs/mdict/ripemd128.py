@@ -14,6 +14,8 @@ Usage:
 
 import struct
 
+_BLOCK = struct.Struct("<16L")
+
 
 # follows this description: http://homes.esat.kuleuven.be/~bosselae/ripemd/rmd128.txt
 
@@ -65,17 +67,10 @@ def padandsplit(message):
     """
     origlen = len(message)
     padlength = 64 - ((origlen - 56) % 64)  # minimum padding is 1!
-    message += b"\x80"
-    message += b"\x00" * (padlength - 1)
-    message += struct.pack("<Q", origlen * 8)
+    # a new buffer, += would extend a bytearray message of the caller in place
+    message = message + b"\x80" + b"\x00" * (padlength - 1) + struct.pack("<Q", origlen * 8)
     assert (len(message) % 64 == 0)
-    return [
-        [
-            struct.unpack("<L", message[i + j:i + j + 4])[0]
-            for j in range(0, 64, 4)
-        ]
-        for i in range(0, len(message), 64)
-    ]
+    return [list(_BLOCK.unpack_from(message, i)) for i in range(0, len(message), 64)]
 
 
 def add(*args):
@@ -105,27 +100,62 @@ sp = [8, 9, 9, 11, 13, 15, 15, 5, 7, 7, 8, 11, 14, 14, 12, 6,
       15, 5, 8, 11, 14, 14, 6, 14, 6, 9, 12, 9, 12, 5, 15, 8]
 
 
+# constants of every step, looked up once instead of through K(j) and Kp(j)
+_K = [K(j) for j in range(64)]
+_KP = [Kp(j) for j in range(64)]
+
+# digests of short messages, MDict hashes the same few keys every time a dictionary is opened
+_DIGEST_CACHE_SIZE = 256
+_CACHED_MESSAGE_LENGTH = 64
+_digest_cache = {}
+
+
+def _compress(h0, h1, h2, h3, X):
+    M = 0xffffffff
+    (A, B, C, D) = (h0, h1, h2, h3)
+    (Ap, Bp, Cp, Dp) = (h0, h1, h2, h3)
+    for j in range(64):
+        # f(j, B, C, D) and f(63 - j, Bp, Cp, Dp), inlined
+        if j < 16:
+            F = B ^ C ^ D
+            Fp = (Bp & Dp) | (Cp & ~Dp)
+        elif j < 32:
+            F = (B & C) | (D & ~B)
+            Fp = (Bp | (M & ~Cp)) ^ Dp
+        elif j < 48:
+            F = (B | (M & ~C)) ^ D
+            Fp = (Bp & Cp) | (Dp & ~Bp)
+        else:
+            F = (B & D) | (C & ~D)
+            Fp = Bp ^ Cp ^ Dp
+        T = (A + F + X[r[j]] + _K[j]) & M
+        T = (T << s[j] | T >> (32 - s[j])) & M
+        (A, D, C, B) = (D, C, B, T)
+        T = (Ap + Fp + X[rp[j]] + _KP[j]) & M
+        T = (T << sp[j] | T >> (32 - sp[j])) & M
+        (Ap, Dp, Cp, Bp) = (Dp, Cp, Bp, T)
+    return ((h2 + D + Ap) & M, (h3 + A + Bp) & M, (h0 + B + Cp) & M, (h1 + C + Dp) & M)
+
+
 def ripemd128(message):
+    # only immutable messages can key the cache, bytearray / memoryview are hashed every time
+    cacheable = isinstance(message, bytes) and len(message) <= _CACHED_MESSAGE_LENGTH
+    if cacheable:
+        digest = _digest_cache.get(message)
+        if digest is not None:
+            return digest
     h0 = 0x67452301
     h1 = 0xefcdab89
     h2 = 0x98badcfe
     h3 = 0x10325476
-    X = padandsplit(message)
-    for i in range(len(X)):
-        (A, B, C, D) = (h0, h1, h2, h3)
-        (Ap, Bp, Cp, Dp) = (h0, h1, h2, h3)
-        for j in range(64):
-            T = rol(s[j], add(A, f(j, B, C, D), X[i][r[j]], K(j)))
-            (A, D, C, B) = (D, C, B, T)
-            T = rol(sp[j], add(Ap, f(63 - j, Bp, Cp, Dp), X[i][rp[j]], Kp(j)))
-            (Ap, Dp, Cp, Bp) = (Dp, Cp, Bp, T)
-        T = add(h1, C, Dp)
-        h1 = add(h2, D, Ap)
-        h2 = add(h3, A, Bp)
-        h3 = add(h0, B, Cp)
-        h0 = T
-
-    return struct.pack("<LLLL", h0, h1, h2, h3)
+    for X in padandsplit(message):
+        (h1, h2, h3, h0) = _compress(h0, h1, h2, h3, X)
+    digest = struct.pack("<LLLL", h0, h1, h2, h3)
+    if cacheable:
+        if len(_digest_cache) >= _DIGEST_CACHE_SIZE:
+            _digest_cache.clear()
+        _digest_cache[message] = digest
+    return digest
 
 
 def hexstr(bstr):
@@ -1,10 +1,22 @@
 # -*- coding:utf-8 -*-
 import gzip
 import hashlib
+import mmap
 import os
-import re
+import sys
+import threading
 import warnings
-from struct import unpack
+import zlib
+from array import array
+from collections import OrderedDict
+from struct import Struct, unpack
+
+try:
+    array('Q')
+    _OFFSET_TYPECODE = 'Q'
+except ValueError:
+    # python 2 has no 'Q' arrays
+    _OFFSET_TYPECODE = 'L'
 
 
 class _StarDictIfo(object):
@@ -77,16 +89,10 @@ class _StarDictIfo(object):
             raise Exception('ifo has no wordcount')
         self.wordcount = int(self.wordcount)
 
-        if self.version == '3.0.0':
-            try:
-                # _syn = open('%s.syn' % dict_prefix)    # not used
-                self.synwordcount = _config.get('synwordcount', None)
-                if self.synwordcount is None:
-                    raise Exception(
-                        'ifo has no synwordcount but .syn file exists')
-                self.synwordcount = int(self.synwordcount)
-            except IOError:
-                pass
+        # only required along with a .syn file, checked when the .syn is read
+        self.synwordcount = _config.get('synwordcount', None)
+        if self.synwordcount is not None:
+            self.synwordcount = int(self.synwordcount)
 
         self.idxfilesize = _config.get('idxfilesize', None)
         if self.idxfilesize is None:
@@ -109,7 +115,104 @@ class _StarDictIfo(object):
         self.sametypesequence = _config.get('sametypesequence', '').strip()
 
 
-class _StarDictIdx(object):
+class _SortedWordFile(object):
+    """
+    Records of a word list sorted as StarDict sorts it (.idx, .syn): a utf-8 word terminated by '\0' followed by
+    fixed-width cords. The file is kept as is, only the start of every record is held in memory, words are
+    looked up by binary search.
+    """
+
+    def _load(self, buf, cords):
+        """
+        buf: content of the file, cords: Struct of the fields following each word
+        """
+        self._file = buf
+        self._cords = cords
+        self._word_starts = _scan_records(buf, cords.size)
+        # word -> ordinal, only built for a file not sorted as StarDict sorts it
+        self._idx = None
+        self._sorted_checked = False
+
+    def close(self):
+        """
+        unmaps the file, a mapped file can be neither replaced nor removed on Windows
+        """
+        if isinstance(self._file, mmap.mmap):
+            self._file.close()
+        self._file = b''
+        self._word_starts = array(_OFFSET_TYPECODE)
+        self._idx = None
+
+    def _word(self, i):
+        """
+        returns the utf-8 word of the i-th record
+        """
+        start = self._word_starts[i]
+        if i + 1 < len(self._word_starts):
+            end = self._word_starts[i + 1] - self._cords.size - 1
+        else:
+            end = len(self._file) - self._cords.size - 1
+        return self._file[start:end]
+
+    def _record_cords(self, i):
+        if i + 1 < len(self._word_starts):
+            cords_pos = self._word_starts[i + 1] - self._cords.size
+        else:
+            cords_pos = len(self._file) - self._cords.size
+        return self._cords.unpack_from(self._file, cords_pos)
+
+    def _bisect(self, word):
+        """
+        returns ordinal of the last record of word, -1 if the sorted file has no such word
+        """
+        target = _stardict_key(word)
+        buf = self._file
+        starts = self._word_starts
+        n = len(starts)
+        # distance from the start of the next record back to the end of a word
+        tail = self._cords.size + 1
+        last_end = len(buf) - tail
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            w = buf[starts[mid]:starts[mid + 1] - tail if mid + 1 < n else last_end]
+            if target < (w.lower(), w):
+                hi = mid
+            else:
+                lo = mid + 1
+        if lo and self._word(lo - 1) == word:
+            return lo - 1
+        return -1
+
+    def _check_sorted(self):
+        """
+        StarDict sorts the file by its comparator, fall back to a dict for a file which is not
+        """
+        self._sorted_checked = True
+        previous = None
+        for i in range(len(self._word_starts)):
+            key = _stardict_key(self._word(i))
+            if previous is not None and key < previous:
+                self._idx = dict((self._word(j), j) for j in range(len(self._word_starts)))
+                return
+            previous = key
+
+    def _ordinal(self, word):
+        """
+        returns ordinal of the record of the utf-8 word, -1 if the file has no such word
+        """
+        if self._idx is None:
+            i = self._bisect(word)
+            if i >= 0 or self._sorted_checked:
+                return i
+            # a miss may come from an unsorted file, checked once
+            self._check_sorted()
+            if self._idx is None:
+                return -1
+        return self._idx.get(word, -1)
+
+
+class _StarDictIdx(_SortedWordFile):
     """
     The .idx file is just a word list.
 
@@ -133,35 +236,37 @@ class _StarDictIdx(object):
             # warn(e.message)
             raise Exception('.idx file does not exists')
 
-        self._file = file.read()
+        """ the sorted idx is kept as is, memory-mapped unless gzipped """
+        try:
+            buf = _map_file(file)
+        finally:
+            file.close()
 
         """ check file size """
-        if file.tell() != container.ifo.idxfilesize:
+        if len(buf) != container.ifo.idxfilesize:
             raise Exception('size of the .idx file is incorrect')
-        file.close()
 
-        """ prepare main dict and parsing parameters """
-        self._idx = {}
+        """ parsing parameters """
         idx_offset_bytes_size = int(container.ifo.idxoffsetbits / 8)
         idx_offset_format = {4: 'L', 8: 'Q', }[idx_offset_bytes_size]
-        idx_cords_bytes_size = idx_offset_bytes_size + 4
 
-        """ parse data via regex """
-        record_pattern = br'([\d\D]+?\x00[\d\D]{' + str(
-            idx_cords_bytes_size).encode('utf-8') + br'})'
-        matched_records = re.findall(record_pattern, self._file)
+        self._load(buf, Struct('>%sL' % idx_offset_format))
 
         """ check records count """
-        if len(matched_records) != container.ifo.wordcount:
+        if len(self._word_starts) != container.ifo.wordcount:
             raise Exception('words count is incorrect')
 
-        """ unpack parsed records """
-        for matched_record in matched_records:
-            c = matched_record.find(b'\x00') + 1
-            record_tuple = unpack(
-                '!%sc%sL' % (c, idx_offset_format), matched_record)
-            word, cords = record_tuple[:c - 1], record_tuple[c:]
-            self._idx[b''.join(word)] = cords
+    def ordinal(self, word):
+        """
+        returns position of word in .idx, -1 if index has no such word
+        """
+        return self._ordinal(word.encode('utf-8'))
+
+    def cords(self, ordinal):
+        """
+        returns tuple (word_data_offset, word_data_size,) of the record at ordinal
+        """
+        return self._record_cords(ordinal)
 
     def __getitem__(self, word):
         """
@@ -169,13 +274,16 @@ class _StarDictIdx(object):
 
         @note: here may be placed flexible search realization
         """
-        return self._idx[word.encode('utf-8')]
+        i = self.ordinal(word)
+        if i < 0:
+            raise KeyError(word)
+        return self.cords(i)
 
     def __contains__(self, k):
         """
         returns True if index has a word k, else False
         """
-        return k.encode('utf-8') in self._idx
+        return self.ordinal(k) >= 0
 
     def __eq__(self, y):
         """
@@ -196,8 +304,8 @@ class _StarDictIdx(object):
         if not self._container.in_memory:
             warnings.warn(
                 'Iter dict items with in_memory=False may cause serious performance problem')
-        for key in self._idx.iterkeys():
-            yield key.decode('utf-8')
+        for i in range(len(self._word_starts)):
+            yield self._word(i).decode('utf-8')
 
     def keys(self):
         """
@@ -209,7 +317,45 @@ class _StarDictIdx(object):
         if not self._container.in_memory:
             warnings.warn(
                 'Iter dict items with in_memory=False may cause serious performance problem')
-        return [key.decode('utf-8') for key in self._idx.keys()]
+        return [self._word(i).decode('utf-8') for i in range(len(self._word_starts))]
+
+
+def _stardict_key(word):
+    """
+    sort key of StarDict's stardict_strcmp: g_ascii_strcasecmp, then strcmp to break ties
+    """
+    return word.lower(), word
+
+
+def _scan_records(buf, cords_size):
+    """
+    returns array of the start of every record of a word list (.idx, .syn), each one is a NUL-terminated word
+    followed by cords_size bytes of cords
+    """
+    starts = array(_OFFSET_TYPECODE)
+    find = buf.find
+    end = len(buf)
+    pos = 0
+    while pos < end:
+        nul = find(b'\x00', pos)
+        if nul < 0 or nul + 1 + cords_size > end:
+            raise Exception('word list file is truncated')
+        starts.append(pos)
+        pos = nul + 1 + cords_size
+    return starts
+
+
+def _map_file(file):
+    """
+    returns the content of a file opened by open_file, memory-mapped if it is a regular file
+    """
+    if isinstance(file, (gzip.GzipFile, DictzipFile)):
+        return file.read()
+    try:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        # empty file, or a file mmap cannot handle
+        return file.read()
 
 
 class _StarDictDict(object):
@@ -378,8 +524,19 @@ class _StarDictDict(object):
         """
 
         # getting word data coordinates
-        cords = self._container.idx[word]
+        return self.read(self._container.idx[word])
 
+    def close(self):
+        """
+        closes the .dict file
+        """
+        if not self._in_memory:
+            self._file.close()
+
+    def read(self, cords):
+        """
+        returns data from .dict at cords (word_data_offset, word_data_size,)
+        """
         if self._in_memory:
             bytes_ = self._file[cords[0]: cords[0] + cords[1]]
         else:
@@ -392,17 +549,55 @@ class _StarDictDict(object):
         return bytes_.decode('utf-8')
 
 
-class _StarDictSyn(object):
+class _StarDictSyn(_SortedWordFile):
+    """
+    The .syn file is optional, it lists synonyms of the words of the .idx.
+
+    The synonym list is sorted like the word list of the .idx.
+
+    Each entry in the synonym list contains two fields, one after the other:
+         synonym_word;  // a utf-8 string terminated by '\0'.
+         original_word_index;  // original word's index in .idx file, a 32-bit number in network byte order
+    """
 
     def __init__(self, dict_prefix, container):
 
         syn_filename = '%s.syn' % dict_prefix
 
         try:
-            self._file = open(syn_filename)
+            file = open(syn_filename, 'rb')
         except IOError:
-            # syn file is optional, passing silently
-            pass
+            # syn file is optional, an empty synonym list
+            buf = b''
+        else:
+            try:
+                buf = _map_file(file)
+            finally:
+                file.close()
+
+        self._load(buf, Struct('>L'))
+
+        """ check records count """
+        if buf:
+            if container.ifo.synwordcount is None:
+                raise Exception('ifo has no synwordcount but .syn file exists')
+            if len(self._word_starts) != container.ifo.synwordcount:
+                raise Exception('synonyms count is incorrect')
+
+    def ordinal(self, word):
+        """
+        returns position in .idx of the word word is a synonym of, -1 if word is no synonym
+        """
+        i = self._ordinal(word.encode('utf-8'))
+        if i < 0:
+            return -1
+        return self._record_cords(i)[0]
+
+    def __contains__(self, k):
+        return self.ordinal(k) >= 0
+
+    def __len__(self):
+        return len(self._word_starts)
 
 
 class Dictionary(dict):
@@ -440,6 +635,8 @@ class Dictionary(dict):
 
         self.ifo = None
         self.idx = None
+        self.dict = None
+        self.syn = None
 
     def get_header(self):
         # reading somedict.ifo
@@ -473,11 +670,20 @@ class Dictionary(dict):
         """
         raise NotImplementedError()
 
+    def _ordinal(self, k):
+        """
+        returns position in x.idx of the word k or of the word k is a synonym of, -1 if there is none
+        """
+        i = self.idx.ordinal(k)
+        if i < 0 and self.syn:
+            i = self.syn.ordinal(k)
+        return i
+
     def __contains__(self, k):
         """
-        returns True if x.idx has a word k, else False
+        returns True if x.idx or x.syn has a word k, else False
         """
-        return k in self.idx
+        return self._ordinal(k) >= 0
 
     def __delitem__(self, k):
         """
@@ -504,7 +710,10 @@ class Dictionary(dict):
         if k in self._dict_cache:
             return self._dict_cache[k]
         else:
-            value = self.dict[k]
+            i = self._ordinal(k)
+            if i < 0:
+                raise KeyError(k)
+            value = self.dict.read(self.idx.cords(i))
             self._dict_cache[k] = value
             return value
 
@@ -562,13 +771,28 @@ class Dictionary(dict):
         """
         self._dict_cache = dict()
 
+    def close(self):
+        """
+        closes the dictionary files and clears dict cache, check_build opens them again
+        """
+        for part in (self.idx, self.dict, self.syn):
+            if part is not None:
+                part.close()
+        self.idx = None
+        self.dict = None
+        self.syn = None
+        self.clear()
+
     def get(self, k, d=''):
         """
-        returns translation of the word k from self.dict or d if k not in x.idx
+        returns translation of the word k from self.dict or d if k not in x.idx nor x.syn
 
         d defaults to empty string
         """
-        return k in self and self[k] or d
+        try:
+            return self[k] or d
+        except KeyError:
+            return d
 
     def has_key(self, k):
         """
@@ -656,9 +880,161 @@ class Dictionary(dict):
         raise NotImplementedError()
 
 
+class DictzipFile(object):
+    """
+    Random-access reader of a dictzip file (.dict.dz).
+
+    A dictzip file is a gzip file whose deflate stream is cut in chunks of CHLEN bytes, each chunk compressed
+    independently of the others. The compressed size of every chunk is listed in the 'RA' subfield of the gzip
+    extra field, so a read only inflates the chunks covering it. The last decompressed chunks are kept in a
+    small LRU, neighbouring words usually share a chunk.
+    """
+    _FTEXT, _FHCRC, _FEXTRA, _FNAME, _FCOMMENT = 1, 2, 4, 8, 16
+
+    def __init__(self, filename, max_cached_chunks=16):
+        self._file = open(filename, 'rb')
+        try:
+            self._read_header()
+        except Exception:
+            self._file.close()
+            raise
+        self._pos = 0
+        self._size = None
+        self.max_cached_chunks = max_cached_chunks
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def is_dictzip(cls, filename):
+        """
+        returns True if filename is a gzip file with a dictzip chunk table
+        """
+        try:
+            with open(filename, 'rb') as f:
+                return cls._parse_chunk_table(f) is not None
+        except (EnvironmentError, ValueError):
+            return False
+
+    @classmethod
+    def _parse_chunk_table(cls, f):
+        """
+        reads the gzip header from f
+
+        returns (chunk length, [compressed size of every chunk]), None if the header has no 'RA' subfield
+        """
+        header = f.read(10)
+        if len(header) < 10 or header[:2] != b'\x1f\x8b' or header[2:3] != b'\x08':
+            raise ValueError('not a gzip file')
+        flags = bytearray(header)[3]
+        if not flags & cls._FEXTRA:
+            return None
+        xlen = unpack('<H', f.read(2))[0]
+        extra = f.read(xlen)
+        chunk_table = None
+        i = 0
+        while i + 4 <= len(extra):
+            subfield_id = extra[i:i + 2]
+            length = unpack('<H', extra[i + 2:i + 4])[0]
+            if subfield_id == b'RA':
+                data = extra[i + 4:i + 4 + length]
+                version, chunk_length, chunk_count = unpack('<HHH', data[:6])
+                if version != 1:
+                    raise ValueError('unsupported dictzip version %s' % version)
+                chunk_table = chunk_length, list(unpack('<%sH' % chunk_count, data[6:6 + 2 * chunk_count]))
+            i += 4 + length
+        # skip the rest of the header, the deflate stream follows it
+        for flag in (cls._FNAME, cls._FCOMMENT):
+            if flags & flag:
+                while f.read(1) not in (b'\x00', b''):
+                    pass
+        if flags & cls._FHCRC:
+            f.read(2)
+        return chunk_table
+
+    def _read_header(self):
+        chunk_table = self._parse_chunk_table(self._file)
+        if chunk_table is None:
+            raise ValueError('%s has no dictzip chunk table' % self._file.name)
+        self._chunk_length, chunk_sizes = chunk_table
+        # offset of every chunk in the file
+        self._chunk_offsets = array(_OFFSET_TYPECODE)
+        offset = self._file.tell()
+        for size in chunk_sizes:
+            self._chunk_offsets.append(offset)
+            offset += size
+        self._chunk_offsets.append(offset)
+        self._chunk_count = len(chunk_sizes)
+
+    @property
+    def size(self):
+        """
+        uncompressed size, every chunk but the last one holds chunk length bytes
+        """
+        if self._size is None:
+            if self._chunk_count:
+                last = self._chunk_count - 1
+                self._size = last * self._chunk_length + len(self._chunk(last))
+            else:
+                self._size = 0
+        return self._size
+
+    def _chunk(self, i):
+        with self._lock:
+            chunk = self._chunks.pop(i, None)
+            if chunk is None:
+                self._file.seek(self._chunk_offsets[i])
+                compressed = self._file.read(self._chunk_offsets[i + 1] - self._chunk_offsets[i])
+                # raw deflate, every chunk ends with a full flush
+                chunk = zlib.decompressobj(-zlib.MAX_WBITS).decompress(compressed)
+                if len(self._chunks) >= self.max_cached_chunks:
+                    self._chunks.popitem(last=False)
+            # re-insert as most recently used
+            self._chunks[i] = chunk
+            return chunk
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self._pos + size, self.size)
+        parts = []
+        pos = self._pos
+        while pos < end:
+            i = pos // self._chunk_length
+            offset = pos - i * self._chunk_length
+            part = self._chunk(i)[offset:offset + end - pos]
+            if not part:
+                break
+            parts.append(part)
+            pos += len(part)
+        self._pos = pos
+        return b''.join(parts)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('negative seek position %s' % offset)
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._file.close()
+        self._chunks.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 def open_file(regular, gz):
     """
     Open regular file if it exists, gz file otherwise.
+    A gz file with a dictzip chunk table is opened for random access.
     If no file exists, raise ValueError.
     """
     try:
@@ -666,6 +1042,8 @@ def open_file(regular, gz):
     except IOError as e:
         # warn(e.message)
         try:
+            if DictzipFile.is_dictzip(gz):
+                return DictzipFile(gz)
             return gzip.open(gz, 'rb')
         except IOError:
             # warn(e.message)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# Created: 10/18/2026
+# Project : AnKindle
+import os
+import threading
+
+from aqt import QThread, QTimer, pyqtSignal, QWidget, QHBoxLayout, QLabel, QToolButton
+from aqt.utils import tooltip
+from .config import Config
+from .dictionary import check_summary, open_backend, StardictBackend
+from .lang import _trans
+from .libs.mdict.mdict_query import BuildCancelled
+
+# milliseconds the indexing errors stay in the status bar
+ERRORS_DISPLAY_MS = 10000
+
+
+def configured_mdx_files():
+    """
+    every dictionary (MDX or StarDict) set up for any language, with the dictionaries of AnKindle Plus if available
+    """
+    from . import _try_ext_module
+    mdx_files = []
+    for lang, lang_config in Config.lang_config.items():
+        mdx_files.append(lang_config.get("mdx_path"))
+        if _try_ext_module():
+            from .AnKindlePlus import GetMDXConfig
+            mdx_files.extend(GetMDXConfig(lang))
+    files = []
+    for mdx_file in mdx_files:
+        if mdx_file and os.path.isfile(mdx_file) and mdx_file not in files:
+            files.append(mdx_file)
+    return files
+
+
+class IndexWarmup(QThread):
+    """
+    Builds the missing or outdated indexes of the configured dictionaries in the background, so that an import
+    starts against ready indexes. Cancellation stops the build under way within one index row, the previous
+    index of that dictionary is kept.
+
+    StarDict dictionaries have no index on disk, they are loaded in memory and held until :meth:`release`, so
+    that the imports share them instead of loading them again.
+    """
+    progress = pyqtSignal(int, int, object)  # dictionaries done, total, dictionary being indexed
+
+    def __init__(self, parent, mdx_files):
+        super(IndexWarmup, self).__init__(parent)
+        self.mdx_files = mdx_files
+        self.errors = []  # [(mdx_file, exception or error message), ]
+        self.check_stats = {}  # {.mdx / .mdd file: check_stats} of the indexes built with check, see open_index
+        self._cancelled = threading.Event()
+        self._held = []  # backends kept open until release()
+        self._held_lock = threading.Lock()
+        self._released = False
+
+    def release(self):
+        """
+        close the dictionaries held by the warm-up, called once the profile is unloaded
+        """
+        with self._held_lock:
+            self._released = True
+            held, self._held = self._held, []
+        for backend in held:
+            backend.close()
+
+    def _hold_or_close(self, backend):
+        with self._held_lock:
+            if isinstance(backend, StardictBackend) and not self._released:
+                self._held.append(backend)
+                return
+        backend.close()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def run(self):
+        for i, mdx_file in enumerate(self.mdx_files):
+            if self.cancelled:
+                return
+            self.progress.emit(i, len(self.mdx_files), mdx_file)
+            try:
+                backend = open_backend(mdx_file, self._cancelled)
+            except BuildCancelled:
+                return
+            except Exception as e:
+                self.errors.append((mdx_file, e))
+                continue
+            self.errors.extend((mdx_file, what) for what, tb in backend.errors)
+            self.check_stats.update(backend.check_stats)
+            self._hold_or_close(backend)
+        self.progress.emit(len(self.mdx_files), len(self.mdx_files), u'')
+
+
+class WarmupStatus(QWidget):
+    """
+    status bar widget showing the dictionary being indexed, with a button to stop the warm-up
+    """
+
+    def __init__(self, parent, warmup):
+        super(WarmupStatus, self).__init__(parent)
+        self.warmup = warmup
+        self.label = QLabel(self)
+        self.btn_cancel = QToolButton(self)
+        self.btn_cancel.setText(u"✕")
+        self.btn_cancel.setAutoRaise(True)
+        self.btn_cancel.setToolTip(_trans("STOP INDEXING"))
+        self.btn_cancel.clicked.connect(self.on_cancel)
+        l = QHBoxLayout(self)
+        l.setContentsMargins(0, 0, 0, 0)
+        l.addWidget(self.label)
+        l.addWidget(self.btn_cancel)
+        warmup.progress.connect(self.on_progress)
+
+    def on_progress(self, done, total, mdx_file):
+        if mdx_file:
+            self.label.setText(_trans("INDEXING MDX") % (
+                os.path.splitext(os.path.basename(mdx_file))[0], done + 1, total))
+
+    def on_cancel(self):
+        self.btn_cancel.setEnabled(False)
+        self.warmup.cancel()
+
+    def show_errors(self, errors):
+        self.btn_cancel.hide()
+        self.label.setText(_trans("INDEXING FAILED") % len(errors))
+        self.label.setToolTip(u"\n".join(u"{}: {}".format(os.path.basename(mdx_file), e) for mdx_file, e in errors))
+
+
+def start_index_warmup(mw):
+    """
+    start indexing the configured dictionaries at low priority, progress is shown in the status bar of mw
+
+    :return: the running IndexWarmup, None if there is nothing to index
+    """
+    mdx_files = configured_mdx_files()
+    if not mdx_files:
+        return None
+    warmup = IndexWarmup(mw, mdx_files)
+    status_bar = mw.statusBar()
+    status_bar_was_visible = status_bar.isVisible()
+    status = WarmupStatus(status_bar, warmup)
+    status_bar.addPermanentWidget(status)
+    status_bar.setVisible(True)
+
+    def remove_status():
+        status_bar.removeWidget(status)
+        status.deleteLater()
+        status_bar.setVisible(status_bar_was_visible)
+
+    def on_finished():
+        if warmup.check_stats:
+            tooltip(u"AnKindle: " + check_summary(warmup.check_stats), period=5000, parent=mw)
+        if warmup.errors:
+            status.show_errors(warmup.errors)
+            QTimer.singleShot(ERRORS_DISPLAY_MS, remove_status)
+        else:
+            remove_status()
+
+    warmup.finished.connect(on_finished)
+    warmup.start(QThread.LowestPriority)
+    return warmup
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# Created: 10/18/2026
+# Project : AnKindle
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "AnKindle", "libs"))
+
+mdict_query = None
+# stand-ins for aqt / aqt.utils when run outside Anki, removed by tearDownModule
+_aqt_stubs = []
+
+
+def setUpModule():
+    global mdict_query
+    try:
+        import aqt.utils
+    except ImportError:
+        # mdict_query and readmdict import the message boxes of aqt.utils, never called by the index build
+        aqt = types.ModuleType("aqt")
+        aqt.utils = types.ModuleType("aqt.utils")
+        aqt.utils.showInfo = aqt.utils.showText = aqt.utils.tooltip = lambda *args, **kwargs: None
+        sys.modules["aqt"] = aqt
+        sys.modules["aqt.utils"] = aqt.utils
+        _aqt_stubs.extend(["aqt", "aqt.utils"])
+    from mdict import mdict_query
+
+
+def tearDownModule():
+    while _aqt_stubs:
+        del sys.modules[_aqt_stubs.pop()]
+
+
+class _FakeMDX(object):
+    """
+    stands for readmdict.MDX, header and index rows of the dictionary currently at the path
+    """
+    headers = {}
+
+    def __init__(self, fname, only_header=False):
+        self._fname = fname
+        self.meta = self.headers[fname]
+        self._encoding = self.meta['encoding']
+
+    def get_index(self, check_block=True, workers=1):
+        return iter([(u'word', 0, 10, 10, 2, 0, 10, 0)])
+
+
+class FileFingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, "dict.mdx")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _fingerprint(self, content):
+        with open(self.fname, 'wb') as f:
+            f.write(content)
+        return mdict_query.file_fingerprint(self.fname, sample_size=16)
+
+    def test_same_content_same_fingerprint(self):
+        self.assertEqual(self._fingerprint(b'a' * 100), self._fingerprint(b'a' * 100))
+
+    def test_changed_head_or_tail_changes_fingerprint(self):
+        content = b'a' * 100
+        fingerprint = self._fingerprint(content)
+        self.assertNotEqual(fingerprint, self._fingerprint(b'b' + content[1:]))
+        self.assertNotEqual(fingerprint, self._fingerprint(content[:-1] + b'b'))
+
+    def test_size_is_part_of_fingerprint(self):
+        self.assertTrue(self._fingerprint(b'a' * 10).startswith(u'10:'))
+
+
+class _IndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._mdx_class = mdict_query.MDX
+        mdict_query.MDX = _FakeMDX
+        self.dir = tempfile.mkdtemp()
+        self.mdx_file = os.path.join(self.dir, "dict.mdx")
+
+    def tearDown(self):
+        mdict_query.MDX = self._mdx_class
+        shutil.rmtree(self.dir)
+
+    def _put_mdx(self, content, encoding, title, stylesheet):
+        with open(self.mdx_file, 'wb') as f:
+            f.write(content)
+        _FakeMDX.headers[self.mdx_file] = {'encoding': encoding, 'title': title, 'description': u'',
+                                           'stylesheet': json.dumps(stylesheet)}
+
+    def _build(self):
+        builder = mdict_query.IndexBuilder(self.mdx_file)
+        builder.get_header()
+        builder.check_build()
+        builder.close()
+        return builder
+
+    def _db_meta(self):
+        conn = sqlite3.connect(self.mdx_file + ".db")
+        try:
+            return dict(conn.execute("SELECT key, value FROM META"))
+        finally:
+            conn.close()
+
+
+class IndexIsCurrentTest(_IndexTestCase):
+
+    def _is_current(self):
+        builder = mdict_query.IndexBuilder(self.mdx_file)
+        try:
+            return builder.index_is_current(self.mdx_file + ".db", self.mdx_file)
+        finally:
+            builder.close()
+
+    def _set_mtime(self, mtime):
+        os.utime(self.mdx_file, (mtime, mtime))
+
+    def test_missing_index_is_outdated(self):
+        self._put_mdx(b'utf-8 dictionary', 'UTF-8', u'Old', {})
+        self.assertFalse(self._is_current())
+
+    def test_built_index_is_current(self):
+        self._put_mdx(b'utf-8 dictionary', 'UTF-8', u'Old', {})
+        self._build()
+        self.assertTrue(self._is_current())
+
+    def test_touched_source_is_current(self):
+        self._put_mdx(b'utf-8 dictionary', 'UTF-8', u'Old', {})
+        self._build()
+        self._set_mtime(os.path.getmtime(self.mdx_file) + 100)
+        self.assertTrue(self._is_current())
+
+    def test_replaced_source_of_same_size_is_outdated(self):
+        self._put_mdx(b'utf-8 dictionary', 'UTF-8', u'Old', {})
+        self._build()
+        mtime = os.path.getmtime(self.mdx_file)
+        self._put_mdx(b'utf-8 dictionarY', 'UTF-8', u'Old', {})
+        self._set_mtime(mtime + 100)
+        self.assertFalse(self._is_current())
+
+    def test_index_of_another_format_is_outdated(self):
+        self._put_mdx(b'utf-8 dictionary', 'UTF-8', u'Old', {})
+        self._build()
+        conn = sqlite3.connect(self.mdx_file + ".db")
+        try:
+            conn.execute("UPDATE META SET value = '1' WHERE key = 'index_format'")
+            conn.commit()
+        finally:
+            conn.close()
+        self.assertFalse(self._is_current())
+
+
+class RebuildMetaTest(_IndexTestCase):
+
+    def test_swapped_source_rebuilds_meta_from_new_header(self):
+        self._put_mdx(b'utf-8 dictionary', 'UTF-8', u'Old', {})
+        self._build()
+        self.assertEqual(self._db_meta()['encoding'], 'UTF-8')
+
+        self._put_mdx(b'a bigger utf-16 dictionary', 'UTF-16', u'New', {'1': ['<b>', '</b>']})
+        builder = self._build()
+
+        meta = self._db_meta()
+        self.assertEqual(meta['encoding'], 'UTF-16')
+        self.assertEqual(meta['title'], u'New')
+        self.assertEqual(json.loads(meta['stylesheet']), {'1': ['<b>', '</b>']})
+        self.assertEqual(builder.meta['encoding'], 'UTF-16')
+        self.assertEqual(builder.meta['stylesheet'], {'1': ['<b>', '</b>']})
+
+
+if __name__ == '__main__':
+    unittest.main()